@@ -1,8 +1,16 @@
 import os
+import io
+import base64
 import json
 import math
 import re
+import time
+import hashlib
+import unicodedata
+import threading
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future
 
 import numpy as np
 import pandas as pd
@@ -10,15 +18,21 @@ import streamlit as st
 from zoneinfo import ZoneInfo
 
 import folium
-from folium import GeoJson, GeoJsonTooltip, LayerControl
-from folium.plugins import HeatMap
+from folium import GeoJson, GeoJsonTooltip, JsCode, LayerControl
+from folium.plugins import HeatMap, HeatMapWithTime
 from streamlit_folium import st_folium
 
 import altair as alt
 import streamlit.components.v1 as components
 from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from branca.element import Template, MacroElement
 
+try:
+    import pyarrow.feather as feather
+except ImportError:  # sem pyarrow o snapshot local fica desativado
+    feather = None
+
 # =============================
 # Config geral
 # =============================
@@ -30,6 +44,27 @@ st.set_page_config(
 
 TZ = ZoneInfo("America/Fortaleza")
 
+# O DataFrame da planilha é compartilhado (somente leitura) por todas as
+# sessões; com copy-on-write, filtros e colunas derivadas nunca o alteram.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+SHEET_ID = "12mU_58X2Ezlr_tG7pcinh1kGMY1xgXXXKfyOlXj75rc"
+GID = "1870024591"
+SEP = ","
+
+# Tempo (s) em que a planilha em cache é servida sem consultar o Google Sheets
+SHEET_TTL_S = float(os.environ.get("SHEET_TTL_S", "300"))
+# Intervalo mínimo (s) entre dois downloads, mesmo quando a atualização é forçada
+SHEET_MIN_REFRESH_S = float(os.environ.get("SHEET_MIN_REFRESH_S", "30"))
+# Período (s) do agendador que consulta a planilha em segundo plano
+SHEET_POLL_S = float(os.environ.get("SHEET_POLL_S", "120"))
+
+# Última planilha baixada com sucesso (Feather sem compressão, lida via memory-map)
+SNAPSHOT_PATH = os.environ.get("SHEET_SNAPSHOT_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sheet_snapshot.feather"
+)
+
 # =============================
 # Estilos Modernizados
 # =============================
@@ -211,17 +246,348 @@ footer {visibility: hidden;}
 # =============================
 # Funções auxiliares
 # =============================
+def sheet_csv_url(sheet_id: str, gid: str = "0"):
+    # SHEET_CSV_URL permite apontar para um servidor local (ex.: tests/sheet_server.py)
+    override = os.environ.get("SHEET_CSV_URL")
+    if override:
+        return override
+    return f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
+
+def fetch_sheet_csv(url: str, etag=None, last_modified=None, timeout: float = 30):
+    """GET condicional. Retorna (status, corpo, etag, last_modified); corpo é None em 304."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        with urlopen(Request(url, headers=headers), timeout=timeout) as resp:
+            return (
+                resp.status,
+                resp.read(),
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+            )
+    except HTTPError as e:
+        if e.code == 304:
+            return 304, None, etag, last_modified
+        raise
+
+# Esquema declarado da planilha: só estas colunas são lidas (usecols) e cada
+# uma é tipada uma única vez na ingestão. Números aceitam vírgula decimal.
+SHEET_SCHEMA = {
+    "Ano": "Int16",
+    "Município": "category",
+    "Localidade": "string",
+    "Bairro": "category",
+    "Profundidade_m": "Float64",
+    "Vazão_LH": "Float64",
+    "Vazão_estimada_LH": "Float64",
+    "Cloretos": "Float64",
+    "Monitorado": "category",
+    "Instalado": "category",
+    "Status": "category",
+    "Caixas_apoio": "Int16",
+    "Observações": "string",
+    "Data_visita": "string",
+    "latitude": "Float64",
+    "longitude": "Float64",
+    "Latitude_2": "string",
+    "Link da Foto": "string",
+}
+
+def coerce_numeric(series: pd.Series, dtype: str) -> pd.Series:
+    if not pd.api.types.is_numeric_dtype(series):
+        series = pd.to_numeric(
+            series.astype("string").str.strip().str.replace(",", ".", regex=False),
+            errors="coerce",
+        )
+    if dtype.startswith("Int"):
+        # Valores fracionários ou fora da faixa do tipo numa coluna inteira
+        # são tratados como inválidos
+        faixa = np.iinfo(dtype.lower())
+        series = series.where(
+            series.isna() | ((series == series.round()) & series.between(faixa.min, faixa.max))
+        )
+    return series.astype(dtype)
+
+def parse_sheet_csv(body: bytes, sep: str = ","):
+    text_dtypes = {c: t for c, t in SHEET_SCHEMA.items() if t in ("category", "string")}
+    df = pd.read_csv(
+        io.BytesIO(body),
+        sep=sep,
+        usecols=lambda c: c in SHEET_SCHEMA,
+        dtype=text_dtypes,
+    )
+    for col, dtype in SHEET_SCHEMA.items():
+        if col in df.columns and dtype not in ("category", "string"):
+            df[col] = coerce_numeric(df[col], dtype)
+    return df
+
+def save_snapshot(path: str, df: pd.DataFrame, meta: dict):
+    """Grava o snapshot de forma atômica (arquivo temporário + os.replace)."""
+    if feather is None:
+        return
+    tmp = path + ".tmp"
+    feather.write_feather(df, tmp, compression="uncompressed")
+    os.replace(tmp, path)
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+def load_snapshot(path: str):
+    """Lê o snapshot via memory-map. Retorna (df, meta) ou None se não houver."""
+    if feather is None or not os.path.exists(path) or not os.path.exists(path + ".json"):
+        return None
+    try:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        df = feather.read_table(path, memory_map=True).to_pandas()
+    except Exception:
+        return None
+    return df, meta
+
+class SheetCache:
+    """Cache da planilha compartilhado pelo processo (todas as sessões).
+
+    Dentro do TTL devolve o DataFrame em memória. Depois do TTL revalida com
+    GET condicional (ETag/Last-Modified) e, se o servidor não suportar, compara
+    o hash do conteúdo; só refaz o parse quando a planilha mudou.
+
+    Com snapshot_path, cada download bem-sucedido é gravado em disco. Na
+    partida a frio o snapshot é servido imediatamente e atualizado em segundo
+    plano; se o download falhar, continua servindo a última cópia.
+
+    O conjunto servido é o resultado de `prepare` sobre a planilha bruta
+    (normalização e estruturas derivadas) e é trocado de uma vez só, então
+    os reruns nunca esperam por rede ou parse depois da primeira carga.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        sep: str = ",",
+        ttl_s: float = SHEET_TTL_S,
+        min_refresh_s: float = SHEET_MIN_REFRESH_S,
+        snapshot_path=None,
+        prepare=None,
+    ):
+        self.url = url
+        self.prepare = prepare or (lambda raw: raw)
+        self.sep = sep
+        self.ttl_s = ttl_s
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self.min_refresh_s = min_refresh_s
+        self._entry = None
+        self._inflight = None
+        self._last_fetch_started = float("-inf")
+        self._bg_thread = None
+        self._scheduler = None
+        self._stop = threading.Event()
+        self.last_error = None
+        self.monitor = {
+            "last_success": None,
+            "last_failure": None,
+            "last_error": None,
+            "last_duration_s": None,
+            "snapshot_error": None,
+        }
+        self.stats = {
+            "hits": 0, "misses": 0, "revalidated": 0, "stale": 0,
+            "coalesced": 0, "throttled": 0,
+        }
+
+        snap = load_snapshot(snapshot_path) if snapshot_path else None
+        if snap is not None:
+            raw, meta = snap
+            try:
+                data = self.prepare(raw)
+            except Exception:
+                snap = None
+        if snap is not None:
+            self._entry = {
+                "data": data,
+                "version": (meta.get("digest") or "")[:12],
+                "digest": meta.get("digest"),
+                "etag": meta.get("etag"),
+                "last_modified": meta.get("last_modified"),
+                "checked_at": float("-inf"),
+                "fetched_at": datetime.fromisoformat(meta["fetched_at"]),
+                "source": "snapshot",
+            }
+
+    def _is_fresh(self, entry, now):
+        return entry is not None and now - entry["checked_at"] < self.ttl_s
+
+    def refresh(self, force: bool = False):
+        """Revalida/baixa a planilha com singleflight.
+
+        Só uma requisição sai por vez: quem chega enquanto há um download em
+        andamento espera por ele e recebe o mesmo resultado. Downloads novos
+        respeitam min_refresh_s, inclusive os forçados pelo botão.
+        """
+        with self._lock:
+            flight = self._inflight
+            leader = flight is None
+            if leader:
+                entry = self._entry
+                now = time.monotonic()
+                if entry is not None:
+                    if not force and self._is_fresh(entry, now):
+                        return entry
+                    if now - self._last_fetch_started < self.min_refresh_s:
+                        self.stats["throttled"] += 1
+                        return entry
+                flight = self._inflight = Future()
+                self._last_fetch_started = now
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            return flight.result()
+
+        t0 = time.perf_counter()
+        try:
+            result = self._fetch(self._entry)
+        except Exception as e:
+            self.monitor["last_failure"] = datetime.now(TZ)
+            self.monitor["last_error"] = str(e)
+            flight.set_exception(e)
+            raise
+        else:
+            self.monitor["last_success"] = datetime.now(TZ)
+            flight.set_result(result)
+            return result
+        finally:
+            self.monitor["last_duration_s"] = time.perf_counter() - t0
+            with self._lock:
+                self._inflight = None
+
+    def _fetch(self, entry):
+        now = time.monotonic()
+        status, body, etag, last_modified = fetch_sheet_csv(
+            self.url,
+            etag=entry["etag"] if entry else None,
+            last_modified=entry["last_modified"] if entry else None,
+        )
+        digest = hashlib.sha256(body).hexdigest() if body is not None else None
+
+        if entry is not None and (status == 304 or digest == entry["digest"]):
+            entry["checked_at"] = now
+            entry["etag"] = etag or entry["etag"]
+            entry["last_modified"] = last_modified or entry["last_modified"]
+            entry["source"] = "network"
+            self.stats["revalidated"] += 1
+            self.last_error = None
+            return entry
+
+        raw = parse_sheet_csv(body, sep=self.sep)
+        data = self.prepare(raw)
+        new = {
+            "data": data,
+            "version": digest[:12],
+            "digest": digest,
+            "etag": etag,
+            "last_modified": last_modified,
+            "checked_at": now,
+            "fetched_at": datetime.now(TZ),
+            "source": "network",
+        }
+        with self._lock:
+            self._entry = new
+        self.stats["misses"] += 1
+        self.last_error = None
+
+        if self.snapshot_path:
+            try:
+                save_snapshot(self.snapshot_path, raw, {
+                    "digest": digest,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "fetched_at": new["fetched_at"].isoformat(),
+                })
+                self.monitor["snapshot_error"] = None
+            except Exception as e:
+                # O download deu certo; a falha só afeta a próxima partida a frio
+                self.monitor["snapshot_error"] = str(e)
+        return new
+
+    def _refresh_quietly(self, force: bool = False):
+        try:
+            self.refresh(force=force)
+        except Exception as e:
+            self.last_error = str(e)
+            if self._entry is not None:
+                self._entry["checked_at"] = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._bg_thread is not None and self._bg_thread.is_alive():
+                return
+            self._bg_thread = threading.Thread(target=self._refresh_quietly, daemon=True)
+            self._bg_thread.start()
+
+    def _poll(self, interval_s: float):
+        while not self._stop.wait(interval_s):
+            self._refresh_quietly(force=True)
+
+    def start_scheduler(self, interval_s: float = SHEET_POLL_S):
+        """Inicia (uma vez) a thread que consulta a planilha periodicamente."""
+        with self._lock:
+            if self._scheduler is not None and self._scheduler.is_alive():
+                return
+            self._stop.clear()
+            self._scheduler = threading.Thread(target=self._poll, args=(interval_s,), daemon=True)
+            self._scheduler.start()
+
+    def stop_scheduler(self):
+        """Encerra a thread periódica (chamado quando o recurso sai do cache)."""
+        self._stop.set()
+
+    def get(self):
+        """Entrada atual: {"data", "version", "fetched_at", ...}."""
+        entry = self._entry
+        if entry is None:
+            # Sem nenhuma cópia (primeira carga sem snapshot): precisa esperar
+            return self.refresh()
+
+        if self._is_fresh(entry, time.monotonic()):
+            self.stats["hits"] += 1
+        else:
+            # Serve a versão atual e revalida fora do rerun
+            self.stats["stale"] += 1
+            self._refresh_in_background()
+        return entry
+
+@st.cache_resource(on_release=SheetCache.stop_scheduler)
+def get_sheet_cache(url: str, sep: str = ","):
+    cache = SheetCache(url, sep=sep, snapshot_path=SNAPSHOT_PATH, prepare=prepare_dataset)
+    cache.start_scheduler(SHEET_POLL_S)
+    return cache
+
 def load_from_gsheet_csv(sheet_id: str, gid: str = "0", sep: str = ","):
-    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
+    cache = get_sheet_cache(sheet_csv_url(sheet_id, gid), sep)
     try:
-        df = pd.read_csv(url, sep=sep)
+        entry = cache.get()
     except HTTPError as e:
         st.error(f"Erro HTTP ao acessar o Google Sheets: {e}")
         raise
     except Exception as e:
         st.error(f"Erro ao ler o CSV do Google Sheets: {e}")
         raise
-    return df
+    # Cada sessão passa a usar a versão compartilhada mais recente no rerun
+    version = entry["version"]
+    if st.session_state.get("data_version") not in (None, version):
+        st.toast("📥 Nova versão dos dados carregada")
+    st.session_state["data_version"] = version
+
+    if cache.last_error:
+        st.warning(
+            "⚠️ Não foi possível atualizar a planilha; exibindo a última cópia local "
+            f"de {entry['fetched_at'].astimezone(TZ).strftime('%d/%m/%Y %H:%M')}."
+        )
+    return entry
 
 def gdrive_extract_id(url: str):
     if not isinstance(url, str):
@@ -310,40 +676,42 @@ def render_lightgallery_images(items: list, height_px=420, auto_open: bool = Fal
     """
     components.html(html, height=height_px, scrolling=True)
 
-def make_popup_html(row):
-    safe = lambda v: "-" if v in [None, "", np.nan] else str(v)
-
-    campos = [
-        ("Localidade", "📍"),
-        ("Vazão_LH", "💧"),
-        ("Vazão_estimada_LH", "📊"),
-        ("Monitorado", "🛰️"),
-        ("Instalado", "⚙️"),
-        ("Status", "✅"),
-        ("Caixas_apoio", "📦"),
-        ("Observações", "📝"),
-    ]
+POPUP_CAMPOS = [
+    ("Localidade", "📍"),
+    ("Vazão_LH", "💧"),
+    ("Vazão_estimada_LH", "📊"),
+    ("Monitorado", "🛰️"),
+    ("Instalado", "⚙️"),
+    ("Status", "✅"),
+    ("Caixas_apoio", "📦"),
+    ("Observações", "📝"),
+]
 
+def fmt_popup_valor(col, val):
+    """Texto exibido no popup para o valor de uma coluna."""
+    if col in ["Vazão_LH", "Vazão_estimada_LH"] and pd.notna(val):
+        try:
+            val = f"{float(val):,.2f} L/h".replace(",", "X").replace(".", ",").replace("X", ".")
+        except Exception:
+            pass
+    if col == "Caixas_apoio" and pd.notna(val):
+        try:
+            val = int(val)
+        except Exception:
+            pass
+    return "-" if pd.isna(val) or val == "" else str(val)
+
+def make_popup_html(row, extra=""):
     linhas = []
-    for col, icon in campos:
+    for col, icon in POPUP_CAMPOS:
         if col not in row:
             continue
-        val = row[col]
-        if col in ["Vazão_LH", "Vazão_estimada_LH"] and pd.notna(val):
-            try:
-                val = f"{float(val):,.2f} L/h".replace(",", "X").replace(".", ",").replace("X", ".")
-            except Exception:
-                pass
-        if col == "Caixas_apoio" and pd.notna(val):
-            try:
-                val = int(val)
-            except Exception:
-                pass
+        val = fmt_popup_valor(col, row[col])
         linhas.append(
             f"""
             <div style="display:flex;justify-content:space-between;padding:4px 0;font-size:0.92em;border-bottom:1px solid rgba(255,255,255,0.1);">
                 <span style="font-weight:500;">{icon} {col}:</span>
-                <span style="font-weight:600;text-align:right;">{safe(val)}</span>
+                <span style="font-weight:600;text-align:right;">{val}</span>
             </div>
             """
         )
@@ -375,25 +743,1312 @@ def make_popup_html(row):
             📍 Poço Monitorado
         </div>
         {corpo}
+        {extra}
     </div>
     """
     return html
 
-def normaliza_lower(x):
-    if x is None:
-        return None
-    return str(x).strip().lower()
+def fmt_br_numero(valores, casas: int = 2) -> np.ndarray:
+    """Números no formato pt-BR (1.234,56) para um array inteiro de uma vez; ausentes viram "-".
+
+    Trabalha com inteiros em unidades da última casa. Valores cujo produto
+    fica a um fio do meio (onde o arredondamento poderia cair do outro lado
+    do format do Python) ou enormes vão pelo format, um a um.
+    """
+    v = np.asarray(valores, dtype="float64")
+    ok = np.isfinite(v)
+    a = np.abs(np.where(ok, v, 0.0))
+    x = a * 10 ** casas
+    duvida = ok & ((np.abs(x - np.floor(x) - 0.5) < 1e-6) | (a >= 1e13))
+    inteiro, frac = np.divmod(np.rint(np.where(duvida, 0.0, x)).astype(np.int64), 10 ** casas)
+
+    grupos = [np.char.zfill((inteiro % 1000).astype(str), 3)]
+    inteiro = inteiro // 1000
+    while inteiro.any():
+        grupos.append(np.char.zfill((inteiro % 1000).astype(str), 3))
+        inteiro = inteiro // 1000
+    txt = grupos[-1]
+    for grupo in reversed(grupos[:-1]):
+        txt = np.char.add(np.char.add(txt, "."), grupo)
+    txt = np.char.lstrip(txt, "0.")
+    txt = np.where(txt == "", "0", txt)
+    if casas:
+        txt = np.char.add(np.char.add(txt, ","), np.char.zfill(frac.astype(str), casas))
+    txt = np.where(np.signbit(v), np.char.add("-", txt), txt).astype(object)
+    for k in np.flatnonzero(duvida).tolist():
+        txt[k] = f"{v[k]:,.{casas}f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return np.where(ok, txt, "-")
+
+def fmt_popup_coluna(col, serie: pd.Series) -> np.ndarray:
+    """fmt_popup_valor aplicado a uma coluna inteira de uma vez."""
+    if col in ["Vazão_LH", "Vazão_estimada_LH", "Caixas_apoio"] and pd.api.types.is_numeric_dtype(serie):
+        v = serie.to_numpy(dtype="float64", na_value=np.nan)
+        if col == "Caixas_apoio":
+            ok = np.isfinite(v)
+            return np.where(ok, np.trunc(np.where(ok, v, 0)).astype(np.int64).astype(str), "-")
+        return np.where(np.isfinite(v), np.char.add(fmt_br_numero(v), " L/h"), "-")
+    if col in ["Vazão_LH", "Vazão_estimada_LH", "Caixas_apoio"]:
+        return np.array([fmt_popup_valor(col, val) for val in serie], dtype=object)
+    vazio = serie.isna().to_numpy() | (serie.astype(str) == "").to_numpy()
+    return np.where(vazio, "-", serie.astype(str).to_numpy(dtype=object))
+
+# Modelos str.format do popup por conjunto de colunas, compilados uma vez
+_MODELOS_POPUP = {}
+
+def modelo_popup(cols) -> str:
+    """HTML de make_popup_html com {0}..{n-1} no lugar dos valores e {n} no do extra."""
+    cols = tuple(cols)
+    if cols not in _MODELOS_POPUP:
+        marcas = pd.Series({col: f"\x00{i}\x00" for i, col in enumerate(cols)})
+        html = make_popup_html(marcas, extra=f"\x00{len(cols)}\x00")
+        html = html.replace("{", "{{").replace("}", "}}")
+        _MODELOS_POPUP[cols] = re.sub("\x00(\\d+)\x00", r"{\1}", html)
+    return _MODELOS_POPUP[cols]
+
+def popups_html(df: pd.DataFrame, extras: list) -> list:
+    """HTML do popup de cada linha pelo modelo compilado (o mesmo de make_popup_html)."""
+    cols = [col for col, _ in POPUP_CAMPOS if col in df.columns]
+    modelo = modelo_popup(cols).format
+    valores = [fmt_popup_coluna(col, df[col]).tolist() for col in cols]
+    return [modelo(*vals) for vals in zip(*valores, extras)]
+
+def sparkline_svg(valores, width=220, height=40):
+    """Mini gráfico de linha (SVG inline) com a série de valores; "" se < 2 pontos."""
+    v = np.asarray(valores, dtype="float64")
+    v = v[np.isfinite(v)]
+    if len(v) < 2:
+        return ""
+    lo, hi = v.min(), v.max()
+    ys = np.full(len(v), height / 2) if hi == lo else height - 3 - (v - lo) / (hi - lo) * (height - 6)
+    xs = np.linspace(3, width - 3, len(v))
+    pontos = " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+    return (
+        f'<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        f'<polyline fill="none" stroke="#ffeaa7" stroke-width="2" points="{pontos}"/>'
+        f'<circle cx="{xs[-1]:.1f}" cy="{ys[-1]:.1f}" r="3" fill="#ffeaa7"/></svg>'
+    )
 
 def safe_sum(series):
-    return float(pd.to_numeric(series, errors="coerce").fillna(0).sum())
+    # Colunas já tipadas na ingestão; nulos são ignorados
+    return float(series.sum(skipna=True))
+
+# =============================
+# Preparação dos dados
+# =============================
+MESES_MAP = {
+    1: "Jan", 2: "Fev", 3: "Mar", 4: "Abr",
+    5: "Mai", 6: "Jun", 7: "Jul", 8: "Ago",
+    9: "Set", 10: "Out", 11: "Nov", 12: "Dez",
+}
+
+MESES_DTYPE = pd.CategoricalDtype(list(MESES_MAP.values()), ordered=True)
+
+# Formatos testados em ordem; o que sobrar cai no parser genérico (dia
+# primeiro, exceto quando o texto começa pelo ano)
+DATE_FORMATS = (
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%y",
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d",
+    "%d-%m-%Y",
+)
+
+def parse_visit_dates(series: pd.Series):
+    """Converte as datas parseando cada texto distinto uma única vez.
+
+    Retorna (datas, {formato: quantidade de textos distintos reconhecidos}).
+    """
+    codes, uniques = pd.factorize(series.astype("string").str.strip())
+    texts = pd.Series(uniques, dtype="string")
+    parsed = pd.Series(pd.NaT, index=texts.index, dtype="datetime64[ns]")
+    found = {}
+
+    pending = texts.notna()
+    for fmt in DATE_FORMATS:
+        if not pending.any():
+            break
+        attempt = pd.to_datetime(texts[pending], format=fmt, errors="coerce")
+        ok = attempt.notna()
+        if ok.any():
+            parsed[attempt.index[ok]] = attempt[ok]
+            found[fmt] = int(ok.sum())
+            pending[attempt.index[ok]] = False
+
+    # Ano na frente é sempre ano-mês-dia (ISO 8601 e variantes); dayfirst
+    # valeria "2024-02-03" como 2 de março
+    year_first = texts.str.match(r"\d{4}[-/.]").fillna(False).astype(bool)
+    for mask, dayfirst in ((pending & year_first, False), (pending & ~year_first, True)):
+        if not mask.any():
+            continue
+        attempt = pd.to_datetime(texts[mask], format="mixed", dayfirst=dayfirst, errors="coerce")
+        ok = attempt.notna()
+        parsed[attempt.index[ok]] = attempt[ok]
+        if ok.any():
+            found["outros"] = found.get("outros", 0) + int(ok.sum())
+
+    values = parsed.to_numpy()
+    result = np.where(codes >= 0, values[np.maximum(codes, 0)], np.datetime64("NaT"))
+    return pd.Series(result, index=series.index, dtype="datetime64[ns]"), found
+
+monitorado_map = {
+    "sim": "Sim",
+    "nao": "Não",
+    "não": "Não"
+}
+instalado_map = {
+    "sim": "Sim",
+    "nao": "Não",
+    "não": "Não"
+}
+status_map = {
+    "instalado": "Instalado",
+    "nao_instalado": "Não instalado",
+    "não_instalado": "Não instalado",
+    "desativado": "Desativado",
+    "obstruido": "Obstruído",
+    "obstruído": "Obstruído",
+    "injetado": "Injetado",
+}
+
+CATEGORY_MAPS = {
+    "Monitorado": monitorado_map,
+    "Instalado": instalado_map,
+    "Status": status_map,
+}
+
+def normalize_categories(df: pd.DataFrame, maps: dict) -> dict:
+    """Padroniza colunas categóricas de uma vez só, operando nas categorias.
+
+    Cada categoria distinta é normalizada (strip + lower) e remapeada; os
+    códigos das linhas são apenas reindexados, sem chamar Python por célula.
+    Valores sem mapeamento são mantidos como vieram e devolvidos no
+    relatório {coluna: [valores não mapeados]}.
+    """
+    unmapped = {}
+    for col, mapping in maps.items():
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype("category")
+
+        cats = s.cat.categories.astype(str)
+        target = cats.str.strip().str.lower().map(mapping)
+        hit = target.notna()
+        new_names = np.where(hit, target, cats)
+
+        canonical = set(mapping.values())
+        unmapped[col] = sorted(c for c, h in zip(cats, hit) if not h and c not in canonical)
+
+        # Categorias que colapsam no mesmo valor (ex.: "nao" e "Não") são fundidas
+        uniq, inverse = np.unique(new_names.astype(str), return_inverse=True)
+        codes = s.cat.codes.to_numpy()
+        new_codes = np.where(codes >= 0, inverse[codes], -1)
+        df[col] = pd.Categorical.from_codes(new_codes, categories=uniq)
+    return unmapped
+
+# Colunas de texto repetitivas guardadas como categoria (códigos inteiros pequenos)
+COMPACT_CATEGORIES = ("Município", "Bairro", "Status", "Monitorado", "Instalado", "Localidade")
+COMPACT_FLOAT32 = ("latitude", "longitude")
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Representação compacta: categorias com códigos int8/int16 e coordenadas float32."""
+    for col in COMPACT_CATEGORIES:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    for col in COMPACT_FLOAT32:
+        if col in df.columns:
+            df[col] = df[col].to_numpy(dtype="float32", na_value=np.nan)
+    return df
+
+def primeira_por_chave(chave):
+    """Posições da primeira ocorrência de cada chave inteira, em ordem de linha."""
+    _, primeira = np.unique(chave, return_index=True)
+    return np.sort(primeira)
+
+# Tolerância (m) para considerar duas visitas o mesmo poço; 0 desliga
+WELL_TOLERANCE_M = float(os.environ.get("WELL_TOLERANCE_M", "5"))
+METROS_POR_GRAU = 111_320.0
+
+def componentes(n: int, a, b):
+    """Rótulo (menor índice) do componente conexo de cada nó, dadas as arestas a-b.
+
+    Propagação do menor rótulo com saltos de ponteiro, tudo vetorizado.
+    """
+    labels = np.arange(n)
+    if len(a) == 0:
+        return labels
+    while True:
+        menor = np.minimum(labels[a], labels[b])
+        novo = labels.copy()
+        np.minimum.at(novo, a, menor)
+        np.minimum.at(novo, b, menor)
+        novo = novo[novo]
+        if np.array_equal(novo, labels):
+            return labels
+        labels = novo
+
+# Teto de pares candidatos expandidos de uma vez em pares_proximos
+MAX_PARES_BLOCO = 1_000_000
+
+def comprime_celulas(c):
+    """Renumera células de um eixo a partir de 1 sem perder a vizinhança.
+
+    Células vizinhas continuam a 1 de distância e as demais ficam a 2, então
+    a chave combinada cabe em int64 mesmo com coordenadas muito espalhadas.
+    """
+    u, inv = np.unique(c, return_inverse=True)
+    passo = np.minimum(np.diff(u), 2)
+    return np.concatenate([[1], 1 + np.cumsum(passo)])[inv]
+
+def blocos_de_pares(cont, max_pares: int):
+    """Fatias [b0, b1) de itens cujas contagens somam até max_pares (ao menos 1 item)."""
+    acum = np.cumsum(cont)
+    b0 = 0
+    while b0 < len(cont):
+        base = acum[b0 - 1] if b0 else 0
+        b1 = max(int(np.searchsorted(acum, base + max_pares, side="right")), b0 + 1)
+        yield b0, b1
+        b0 = b1
+
+def pares_proximos(x, y, tol: float, grupo=None, max_pares: int = MAX_PARES_BLOCO):
+    """Pares (i, j), i < j, de pontos de grupos diferentes a até tol metros.
+
+    Usa uma grade de lado tol: cada ponto só é comparado com os pontos das
+    9 células vizinhas. Dentro de cada célula os pontos ficam ordenados por
+    grupo e o bloco do grupo do próprio ponto é pulado, então pares do mesmo
+    grupo nem são gerados. Os candidatos são expandidos em blocos de até
+    max_pares. Sem grupo, cada ponto é o seu próprio grupo.
+    """
+    n = len(x)
+    if grupo is None:
+        gcod = np.arange(n, dtype=np.int64)
+    else:
+        gcod = np.unique(grupo, return_inverse=True)[1].ravel().astype(np.int64)
+    ng = int(gcod.max(initial=0)) + 1
+    cx = comprime_celulas(np.floor(x / tol).astype(np.int64))
+    cy = comprime_celulas(np.floor(y / tol).astype(np.int64))
+    larg = int(cy.max(initial=0)) + 2
+    chave = cx * larg + cy
+    ordem = np.lexsort((gcod, chave))
+    chave_ord = (chave * ng + gcod)[ordem]
+    idx = np.arange(n)
+
+    # Meia vizinhança: a própria célula (com i < j) e 4 das 8 vizinhas,
+    # assim cada par de células é visitado uma única vez
+    pares_a, pares_b = [], []
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        alvo = (chave + dx * larg + dy) * ng
+        lo = np.searchsorted(chave_ord, alvo, side="left")
+        hi = np.searchsorted(chave_ord, alvo + ng, side="left")
+        slo = np.searchsorted(chave_ord, alvo + gcod, side="left")
+        shi = np.searchsorted(chave_ord, alvo + gcod, side="right")
+        # Faixas da célula alvo sem o próprio grupo: [lo, slo) e [shi, hi)
+        dono = np.concatenate([idx, idx])
+        inicio = np.concatenate([lo, shi])
+        cont = np.concatenate([slo - lo, hi - shi])
+        tem = cont > 0
+        dono, inicio, cont = dono[tem], inicio[tem], cont[tem]
+        for b0, b1 in blocos_de_pares(cont, max_pares):
+            c = cont[b0:b1]
+            desloc = np.arange(int(c.sum())) - np.repeat(np.cumsum(c) - c, c)
+            i = np.repeat(dono[b0:b1], c)
+            j = ordem[np.repeat(inicio[b0:b1], c) + desloc]
+            ok = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 <= tol * tol
+            if dx == 0 and dy == 0:
+                ok &= i < j
+            pares_a.append(i[ok])
+            pares_b.append(j[ok])
+    if not pares_a:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    a, b = np.concatenate(pares_a), np.concatenate(pares_b)
+    return np.minimum(a, b), np.maximum(a, b)
+
+def algum_par_proximo(x, y, inicio, cont, a, b, tol: float, max_pares: int = MAX_PARES_BLOCO):
+    """Para cada par de blocos (a[k], b[k]), diz se algum ponto de um fica a até tol do outro.
+
+    Os blocos são fatias [inicio, inicio + cont) de x/y; os produtos são
+    expandidos em blocos de até max_pares comparações.
+    """
+    achou = np.zeros(len(a), dtype=bool)
+    tam = cont[a] * cont[b]
+    for b0, b1 in blocos_de_pares(tam, max_pares):
+        t = tam[b0:b1]
+        k = np.repeat(np.arange(b0, b1), t)
+        r = np.arange(int(t.sum())) - np.repeat(np.cumsum(t) - t, t)
+        i = inicio[a[k]] + r // cont[b[k]]
+        j = inicio[b[k]] + r % cont[b[k]]
+        ok = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 <= tol * tol
+        achou[k[ok]] = True
+    return achou
+
+def agrupa_pocos_proximos(well, lat, lon, tol_m: float):
+    """Une poços cujas visitas ficam a até tol_m metros (ligação simples).
+
+    Parte dos rótulos de Latitude_2 e reduz as visitas de cada poço a um
+    representante por subcélula de lado tol_m/8 (o centro dela). Pares de
+    representantes de poços diferentes a até tol_m mais a folga das
+    subcélulas são candidatos, conferidos depois com as coordenadas reais
+    das visitas; assim visitas repetidas de um poço não multiplicam os
+    pares e o resultado é o mesmo da comparação visita a visita. Visitas sem
+    coordenada mantêm o rótulo original. Devolve rótulos renumerados por
+    primeira aparição.
+    """
+    ok = np.isfinite(lat) & np.isfinite(lon)
+    if tol_m <= 0 or not ok.any():
+        return pd.factorize(well)[0]
+
+    # Projeção equirretangular local (metros), suficiente para a escala da cidade
+    lat0 = np.deg2rad(float(np.mean(lat[ok])))
+    lado = tol_m / 8
+    pts = pd.DataFrame({
+        "w": well[ok],
+        "y": lat[ok] * METROS_POR_GRAU,
+        "x": lon[ok] * METROS_POR_GRAU * np.cos(lat0),
+    }).drop_duplicates()
+    pts["qx"] = np.floor(pts["x"] / lado)
+    pts["qy"] = np.floor(pts["y"] / lado)
+    pts["rep"] = pts.groupby(["w", "qx", "qy"], sort=False).ngroup()
+    pts = pts.sort_values("rep", kind="stable")
+
+    reps = pts.drop_duplicates("rep")
+    cont = np.bincount(pts["rep"].to_numpy(), minlength=len(reps))
+    inicio = np.cumsum(cont) - cont
+    rw = reps["w"].to_numpy()
+    rx = (reps["qx"].to_numpy() + 0.5) * lado
+    ry = (reps["qy"].to_numpy() + 0.5) * lado
+    # Cada visita fica a até meia diagonal (lado·√2/2) do centro da subcélula
+    folga = lado * np.sqrt(2)
+    a, b = pares_proximos(rx, ry, tol_m + folga, grupo=rw)
+
+    # Centros a até tol_m - folga garantem a ligação; os demais candidatos só
+    # são conferidos visita a visita se o par de poços ainda não está ligado
+    perto = np.hypot(rx[a] - rx[b], ry[a] - ry[b]) <= tol_m - folga
+    nw = int(well.max(initial=-1)) + 1
+    par_pocos = np.minimum(rw[a], rw[b]).astype(np.int64) * nw + np.maximum(rw[a], rw[b])
+    confere = ~perto & ~np.isin(par_pocos, par_pocos[perto])
+    perto[confere] = algum_par_proximo(
+        pts["x"].to_numpy(), pts["y"].to_numpy(), inicio, cont, a[confere], b[confere], tol_m
+    )
+    rotulo = componentes(nw, rw[a[perto]], rw[b[perto]])
+    return pd.factorize(rotulo[well])[0]
+
+# Atributos do poço copiados da primeira visita para o cadastro
+WELL_ATTRS = ("Latitude_2", "latitude", "longitude", "Localidade", "Município", "Bairro")
+
+class WellRegistry:
+    """Cadastro de poços (dimensão) e índice das visitas (fato) por poço.
+
+    Cada Latitude_2 distinta vira um poço, e linhas sem Latitude_2 viram
+    poços avulsos (uma visita cada). Depois, poços com visitas a até
+    tolerance_m metros são unidos (GPS varia entre visitas). O well_id é
+    inteiro, na ordem da primeira aparição e um por visita em self.well_id
+    (prepare_dataset grava como coluna well_id do DataFrame); as visitas de
+    cada poço ficam num índice CSR (visits/offsets).
+    """
+
+    def __init__(self, df: pd.DataFrame, tolerance_m: float = WELL_TOLERANCE_M):
+        n = len(df)
+        if "Latitude_2" in df.columns:
+            well, _ = pd.factorize(df["Latitude_2"])
+        else:
+            well = np.full(n, -1, dtype=np.intp)
+        avulsas = well < 0
+        well[avulsas] = well.max(initial=-1) + 1 + np.arange(int(avulsas.sum()))
+        self.tolerance_m = tolerance_m
+        self.n_latitude_2 = int(well.max(initial=-1)) + 1
+        if "latitude" in df.columns and "longitude" in df.columns:
+            well = agrupa_pocos_proximos(
+                well,
+                df["latitude"].to_numpy(dtype="float64", na_value=np.nan),
+                df["longitude"].to_numpy(dtype="float64", na_value=np.nan),
+                tolerance_m,
+            )
+        self.well_id = well.astype(np.int32)
+        self.n_wells = int(self.well_id.max(initial=-1)) + 1
+
+        # Visitas agrupadas por poço, em ordem de linha dentro de cada poço
+        self.visits = np.argsort(self.well_id, kind="stable").astype(np.int32)
+        counts = np.bincount(self.well_id, minlength=self.n_wells)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+        first_row = self.visits[self.offsets[:-1]]
+
+        cols = [c for c in WELL_ATTRS if c in df.columns]
+        self.wells = df[cols].iloc[first_row].reset_index(drop=True)
+        self.wells["n_visitas"] = counts.astype(np.int32)
+        self.wells.index.name = "well_id"
+
+RAIO_TERRA_M = 6_371_008.8
+# Distância máxima (m) entre o clique no mapa e o poço escolhido
+CLICK_SNAP_M = float(os.environ.get("CLICK_SNAP_M", "150"))
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distância geodésica (esfera) em metros; aceita arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * RAIO_TERRA_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class SpatialIndex:
+    """Grade uniforme sobre as coordenadas dos poços (uma por versão dos dados).
+
+    Os pontos ficam ordenados pela chave da célula (CSR), e a busca do
+    vizinho mais próximo percorre anéis de células a partir do clique até
+    que nenhuma célula ainda não vista possa ter um ponto mais perto.
+    """
+
+    def __init__(self, lat, lon, cell_m: float = None):
+        self.lat = np.asarray(lat, dtype="float64")
+        self.lon = np.asarray(lon, dtype="float64")
+        ok = np.flatnonzero(np.isfinite(self.lat) & np.isfinite(self.lon))
+        self.n = len(ok)
+        lat0 = float(np.mean(self.lat[ok])) if self.n else 0.0
+        self.kx = METROS_POR_GRAU * math.cos(math.radians(lat0))
+        self.ky = METROS_POR_GRAU
+        if cell_m is None:
+            # ~2 pontos por célula em média, limitado a [25 m, 5 km]
+            if self.n > 1:
+                area = (np.ptp(self.lon[ok]) * self.kx + 1) * (np.ptp(self.lat[ok]) * self.ky + 1)
+                cell_m = float(np.clip(math.sqrt(2 * area / self.n), 25, 5000))
+            else:
+                cell_m = 1000.0
+        self.cell_m = cell_m
+
+        cx, cy = self._cell(self.lat[ok], self.lon[ok])
+        chave = self._key(cx, cy)
+        ordem = np.argsort(chave, kind="stable")
+        self.ids = ok[ordem]
+        self.chaves, self.inicio = np.unique(chave[ordem], return_index=True)
+        self.fim = np.r_[self.inicio[1:], len(ordem)]
+        # Coordenadas das células ocupadas (para consultas que cobrem muitas células)
+        self.cel_x = self.chaves >> 32
+        cel_y = self.chaves & 0xFFFFFFFF
+        self.cel_y = np.where(cel_y >= 2**31, cel_y - 2**32, cel_y)
+        # Extremos das células ocupadas: limitam quantos anéis a busca percorre
+        if self.n:
+            self.limites = (cx.min(), cx.max(), cy.min(), cy.max())
+
+    def _cell(self, lat, lon):
+        return (
+            np.floor(np.asarray(lon) * self.kx / self.cell_m).astype(np.int64),
+            np.floor(np.asarray(lat) * self.ky / self.cell_m).astype(np.int64),
+        )
+
+    @staticmethod
+    def _key(cx, cy):
+        return (np.asarray(cx, dtype=np.int64) << 32) + (np.asarray(cy, dtype=np.int64) & 0xFFFFFFFF)
+
+    def _ids_cells(self, cx, cy):
+        """Ids dos pontos nas células (cx, cy) dadas (arrays)."""
+        chave = self._key(cx, cy)
+        pos = np.searchsorted(self.chaves, chave)
+        pos = np.minimum(pos, len(self.chaves) - 1)
+        achou = np.unique(pos[self.chaves[pos] == chave])
+        if not len(achou):
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate([self.ids[self.inicio[i]:self.fim[i]] for i in achou])
+
+    def _ids_caixa(self, lat_min, lon_min, lat_max, lon_max):
+        """Ids candidatos nas células que cobrem a caixa (superconjunto do resultado)."""
+        x0, y0 = self._cell(lat_min, lon_min)
+        x1, y1 = self._cell(lat_max, lon_max)
+        area = (int(x1) - int(x0) + 1) * (int(y1) - int(y0) + 1)
+        if area <= 0 or not len(self.chaves):
+            return np.zeros(0, dtype=np.intp)
+        if area > len(self.chaves):
+            # Caixa maior que a parte ocupada da grade: filtra as células ocupadas
+            dentro = np.flatnonzero(
+                (self.cel_x >= x0) & (self.cel_x <= x1) & (self.cel_y >= y0) & (self.cel_y <= y1)
+            )
+            if not len(dentro):
+                return np.zeros(0, dtype=np.intp)
+            return np.concatenate([self.ids[self.inicio[i]:self.fim[i]] for i in dentro])
+        cxs, cys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+        return self._ids_cells(cxs.ravel(), cys.ravel())
+
+    def within_bbox(self, lat_min, lon_min, lat_max, lon_max, permitido=None):
+        """Ids (ordenados) dos pontos dentro da caixa lat/lon dada, bordas incluídas."""
+        ids = self._ids_caixa(lat_min, lon_min, lat_max, lon_max)
+        if permitido is not None:
+            ids = ids[permitido[ids]]
+        lat, lon = self.lat[ids], self.lon[ids]
+        ids = ids[(lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)]
+        return np.sort(ids)
+
+    def within_radius(self, lat: float, lon: float, raio_m: float, permitido=None):
+        """(ids, distâncias em m) dos pontos a até raio_m do centro, do mais perto ao mais longe."""
+        # Caixa que contém o círculo (com folga para a aproximação local da grade)
+        dlat = raio_m * 1.01 / self.ky
+        dlon = raio_m * 1.01 / (METROS_POR_GRAU * max(math.cos(math.radians(lat)), 1e-6))
+        ids = self._ids_caixa(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        if permitido is not None:
+            ids = ids[permitido[ids]]
+        d = haversine_m(lat, lon, self.lat[ids], self.lon[ids])
+        perto = d <= raio_m
+        ids, d = ids[perto], d[perto]
+        ordem = np.lexsort((ids, d))
+        return ids[ordem], d[ordem]
+
+    def nearest(self, lat: float, lon: float, max_m: float = CLICK_SNAP_M, permitido=None):
+        """(id, distância em m) do ponto mais próximo a até max_m; (None, None) se não houver.
+
+        permitido: máscara booleana opcional sobre os ids (ex.: poços visíveis).
+        """
+        if self.n == 0:
+            return None, None
+        cx0, cy0 = self._cell(lat, lon)
+        melhor, melhor_d = None, np.inf
+        xmin, xmax, ymin, ymax = self.limites
+        r_max = max(abs(cx0 - xmin), abs(cx0 - xmax), abs(cy0 - ymin), abs(cy0 - ymax))
+        r = 0
+        while True:
+            if r == 0:
+                cxs, cys = np.array([cx0]), np.array([cy0])
+            else:
+                lado = np.arange(-r, r + 1)
+                cxs = np.r_[cx0 + lado, cx0 + lado, np.full(2 * r - 1, cx0 - r), np.full(2 * r - 1, cx0 + r)]
+                cys = np.r_[np.full(2 * r + 1, cy0 - r), np.full(2 * r + 1, cy0 + r), cy0 + lado[1:-1], cy0 + lado[1:-1]]
+            ids = self._ids_cells(cxs, cys)
+            if permitido is not None and len(ids):
+                ids = ids[permitido[ids]]
+            if len(ids):
+                d = haversine_m(lat, lon, self.lat[ids], self.lon[ids])
+                k = int(np.argmin(d))
+                if d[k] < melhor_d:
+                    melhor, melhor_d = int(ids[k]), float(d[k])
+            # Qualquer célula do próximo anel está a pelo menos r * cell_m do clique
+            alcance = r * self.cell_m
+            if alcance >= min(melhor_d, max_m) or r >= r_max:
+                break
+            r += 1
+        if melhor is None or melhor_d > max_m:
+            return None, None
+        return melhor, melhor_d
+
+# A partir deste zoom o mapa por área visível mostra os poços individuais;
+# abaixo dele, agregados em células de CLUSTER_PX pixels
+ZOOM_POCOS = int(os.environ.get("ZOOM_POCOS", "14"))
+CLUSTER_PX = 64
+LAT_MERCATOR = 85.05112878
+
+def mercator_px(lat, lon, zoom: int):
+    """Coordenadas em pixels do mundo Web Mercator (tiles de 256 px) no zoom dado."""
+    escala = 256 * 2.0 ** zoom
+    sen = np.sin(np.radians(np.clip(lat, -LAT_MERCATOR, LAT_MERCATOR)))
+    x = (np.asarray(lon, dtype="float64") + 180.0) / 360.0 * escala
+    y = (0.5 - np.log((1 + sen) / (1 - sen)) / (4 * np.pi)) * escala
+    return x, y
+
+def mercator_latlon(x, y, zoom: int):
+    """Inverso de mercator_px."""
+    escala = 256 * 2.0 ** zoom
+    lon = np.asarray(x, dtype="float64") / escala * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype="float64") / escala))))
+    return lat, lon
+
+class PiramideClusters:
+    """Hierarquia de grades Web Mercator para agregar poços por nível de zoom.
+
+    Cada poço guarda só a célula que ocupa no nível mais fino (z_max); como
+    o mundo dobra de tamanho a cada zoom, a célula no nível z é a do nível
+    fino deslocada (z_max - z) bits, e todos os níveis saem dos mesmos arrays.
+    """
+
+    def __init__(self, lat, lon, z_max: int = ZOOM_POCOS - 1):
+        self.lat = np.asarray(lat, dtype="float64")
+        self.lon = np.asarray(lon, dtype="float64")
+        self.z_max = z_max
+        ok = np.isfinite(self.lat) & np.isfinite(self.lon)
+        x, y = mercator_px(np.where(ok, self.lat, 0.0), np.where(ok, self.lon, 0.0), z_max)
+        self.cx = (x // CLUSTER_PX).astype(np.int64)
+        self.cy = (y // CLUSTER_PX).astype(np.int64)
+
+    def caixa_celulas(self, zoom: int, caixa):
+        """Caixa lat/lon alinhada às células do nível que cobrem a caixa dada.
+
+        Consultar essa caixa traz todos os poços das células visíveis, e não
+        só os da parte delas que está na tela: os agregados não mudam ao arrastar.
+        """
+        z = min(zoom, self.z_max)
+        lat_min, lon_min, lat_max, lon_max = caixa
+        x0, y1 = mercator_px(lat_min, lon_min, z)
+        x1, y0 = mercator_px(lat_max, lon_max, z)
+        x0, y0 = np.floor(x0 / CLUSTER_PX) * CLUSTER_PX, np.floor(y0 / CLUSTER_PX) * CLUSTER_PX
+        x1, y1 = (np.floor(x1 / CLUSTER_PX) + 1) * CLUSTER_PX, (np.floor(y1 / CLUSTER_PX) + 1) * CLUSTER_PX
+        lat_max, lon_min = mercator_latlon(x0, y0, z)
+        lat_min, lon_max = mercator_latlon(x1, y1, z)
+        return float(lat_min), float(lon_min), float(lat_max), float(lon_max)
+
+    def agrega(self, zoom: int, ids, valores):
+        """Agregados do nível: (lat, lon, n, soma de valores, ids agrupados por célula, offsets).
+
+        lat/lon são o centróide dos poços de cada célula; valores ausentes não somam.
+        """
+        desloc = max(self.z_max - min(zoom, self.z_max), 0)
+        chave = ((self.cx[ids] >> desloc) << 32) + (self.cy[ids] >> desloc)
+        ordem = np.argsort(chave, kind="stable")
+        _, inicio, inv, n = np.unique(
+            chave[ordem], return_index=True, return_inverse=True, return_counts=True
+        )
+        ids = ids[ordem]
+        lat = np.bincount(inv, self.lat[ids]) / n
+        lon = np.bincount(inv, self.lon[ids]) / n
+        soma = np.bincount(inv, np.nan_to_num(valores[ids]))
+        return lat, lon, n, soma, ids, np.r_[inicio, len(ids)]
+
+# Células do mapa de calor no lado maior da área dos poços
+CALOR_CELULAS = int(os.environ.get("CALOR_CELULAS", "128"))
+
+class GradeCalor:
+    """Grade fixa (por versão dos dados) do mapa de calor de vazão.
+
+    Cada visita com coordenadas guarda a célula em que cai; agregar um
+    conjunto de visitas é um bincount sobre essas células, e o que vai ao
+    navegador fica limitado ao número de células, não ao de visitas.
+    """
+
+    def __init__(self, lat, lon, valor, celulas: int = CALOR_CELULAS):
+        lat = np.asarray(lat, dtype="float64")
+        lon = np.asarray(lon, dtype="float64")
+        self.valor = np.asarray(valor, dtype="float64")
+        ok = np.isfinite(lat) & np.isfinite(lon)
+        self.celula = np.full(len(lat), -1, dtype=np.int32)
+        self.nx = self.ny = 0
+        if not ok.any():
+            return
+
+        self.lat_min, self.lon_min = float(lat[ok].min()), float(lon[ok].min())
+        kx = METROS_POR_GRAU * math.cos(math.radians(float(lat[ok].mean())))
+        largura_m = (float(lon[ok].max()) - self.lon_min) * kx
+        altura_m = (float(lat[ok].max()) - self.lat_min) * METROS_POR_GRAU
+        # Células quadradas em metros
+        passo_m = max(largura_m, altura_m, 1.0) / celulas
+        self.dlat = passo_m / METROS_POR_GRAU
+        self.dlon = passo_m / kx
+        self.nx = int(largura_m // passo_m) + 1
+        self.ny = int(altura_m // passo_m) + 1
+
+        ix = np.clip(((lon[ok] - self.lon_min) / self.dlon).astype(np.int64), 0, self.nx - 1)
+        iy = np.clip(((lat[ok] - self.lat_min) / self.dlat).astype(np.int64), 0, self.ny - 1)
+        self.celula[ok] = iy * self.nx + ix
+
+    def centros(self, celulas):
+        """(lat, lon) do centro das células dadas."""
+        iy, ix = np.divmod(np.asarray(celulas, dtype=np.int64), self.nx)
+        return self.lat_min + (iy + 0.5) * self.dlat, self.lon_min + (ix + 0.5) * self.dlon
+
+    def agrega(self, rows) -> dict:
+        """Nº de visitas, soma e máximo da vazão por célula não vazia."""
+        c, v = self.celula[rows], self.valor[rows]
+        tem = (c >= 0) & np.isfinite(v)
+        c, v = c[tem], v[tem]
+        total = self.nx * self.ny
+        n = np.bincount(c, minlength=total)
+        soma = np.bincount(c, v, minlength=total)
+        maximo = np.full(total, -np.inf)
+        np.maximum.at(maximo, c, v)
+        cel = np.flatnonzero(n)
+        return {
+            "celulas": cel.astype(np.int32),
+            "n": n[cel].astype(np.int32),
+            "soma": soma[cel],
+            "max": maximo[cel],
+        }
+
+METRICAS_QUADROS = ("Vazão (soma)", "Visitas a poços instalados")
+# Células dos quadros mensais no lado maior (a grade do calor agrupada em blocos)
+QUADROS_CELULAS = int(os.environ.get("QUADROS_CELULAS", "48"))
+
+class QuadrosMensais:
+    """Quadros mensais (Ano_visita/Mes_visita) sobre blocos de células da GradeCalor.
+
+    Cada visita guarda a chave quadro × células + célula; os quadros de um
+    conjunto de visitas saem de um único agrupamento sobre essas chaves, e o
+    resultado cresce com meses × células ocupadas, não com o nº de visitas.
+    """
+
+    def __init__(self, grade: GradeCalor, ano, mes, instalado, celulas: int = QUADROS_CELULAS):
+        self.grade = grade
+        # Blocos de fator × fator células da grade do calor
+        self.fator = max(1, -(-max(grade.nx, grade.ny) // celulas))
+        self.nx = -(-grade.nx // self.fator)
+        self.n_celulas = self.nx * (-(-grade.ny // self.fator))
+        ano = np.asarray(ano, dtype="float64")
+        mes = np.asarray(mes, dtype="float64")
+        ok = np.isfinite(ano) & np.isfinite(mes) & (grade.celula >= 0)
+        iy, ix = np.divmod(grade.celula[ok].astype(np.int64), grade.nx)
+        bloco = (iy // self.fator) * self.nx + ix // self.fator
+        mes_abs = ano[ok].astype(np.int64) * 12 + mes[ok].astype(np.int64) - 1
+        meses, quadro = np.unique(mes_abs, return_inverse=True)
+        self.rotulos = [f"{MESES_MAP[m % 12 + 1]}/{m // 12}" for m in meses.tolist()]
+        self.chave = np.full(len(ano), -1, dtype=np.int64)
+        self.chave[ok] = quadro * self.n_celulas + bloco
+        self.pesos = {
+            METRICAS_QUADROS[0]: grade.valor,
+            METRICAS_QUADROS[1]: np.asarray(instalado, dtype="float64"),
+        }
+
+    def agrega(self, rows, metrica: str) -> dict:
+        """(quadro, célula, peso somado) de cada par mês × célula com peso positivo."""
+        k = self.chave[rows]
+        peso = self.pesos[metrica][rows]
+        tem = (k >= 0) & np.isfinite(peso) & (peso > 0)
+        chaves, inv = np.unique(k[tem], return_inverse=True)
+        return {
+            "quadro": (chaves // self.n_celulas).astype(np.int32),
+            "celula": (chaves % self.n_celulas).astype(np.int32),
+            "peso": np.bincount(inv, peso[tem], minlength=len(chaves)),
+        }
+
+    def centros(self, celulas):
+        """(lat, lon) do centro dos blocos dados."""
+        iy, ix = np.divmod(np.asarray(celulas, dtype=np.int64), self.nx)
+        g = self.grade
+        return (
+            g.lat_min + (iy + 0.5) * self.fator * g.dlat,
+            g.lon_min + (ix + 0.5) * self.fator * g.dlon,
+        )
+
+# Número de bits ligados em cada byte (contagem sobre bitmaps compactados)
+POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+FILTER_DIMS = ("Ano_visita", "Mes_visita", "Município", "Bairro", "Monitorado", "Instalado", "Status")
+
+class FilterIndex:
+    """Índice de bitmaps para os Filtros Avançados.
+
+    Guarda, para cada valor distinto de cada dimensão, um bitmap compactado
+    (np.packbits) com as linhas que têm aquele valor. Uma combinação de
+    filtros vira OU dos bitmaps escolhidos dentro da dimensão e E entre as
+    dimensões, sem copiar o DataFrame.
+    """
+
+    def __init__(self, df: pd.DataFrame, dims=FILTER_DIMS):
+        self.n = len(df)
+        self.values = {}
+        self.codes = {}
+        self.bitmaps = {}
+        self._pos = {}
+        for dim in dims:
+            if dim not in df.columns:
+                continue
+            s = df[dim]
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                codes = s.cat.codes.to_numpy().astype(np.int32)
+                cats = s.cat.categories
+            else:
+                codes, cats = pd.factorize(s, sort=True)
+                codes = codes.astype(np.int32)
+            # Só valores que aparecem nos dados (categorias podem sobrar)
+            counts = np.bincount(codes[codes >= 0], minlength=len(cats))
+            present = np.flatnonzero(counts)
+            remap = np.full(len(cats) + 1, -1, dtype=np.int32)
+            remap[present] = np.arange(len(present), dtype=np.int32)
+            codes = remap[codes]
+
+            self.codes[dim] = codes
+            self.values[dim] = cats[present].tolist()
+            self._pos[dim] = {v: i for i, v in enumerate(self.values[dim])}
+            self.bitmaps[dim] = np.stack([
+                np.packbits(codes == i) for i in range(len(present))
+            ]) if len(present) else np.zeros((0, (self.n + 7) // 8), dtype=np.uint8)
+
+    def _all(self):
+        return np.packbits(np.ones(self.n, dtype=bool))
+
+    def selected_codes(self, dim, selected):
+        """Códigos (posições em values[dim]) dos valores selecionados."""
+        return [self._pos[dim][v] for v in selected if v in self._pos[dim]]
+
+    def _dim_bits(self, dim, selected):
+        idx = self.selected_codes(dim, selected)
+        if not idx:
+            return np.zeros(self.bitmaps[dim].shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[dim][idx], axis=0)
+
+    def mask(self, selection: dict):
+        """Bitmap compactado das linhas que atendem a seleção {dimensão: valores}."""
+        bits = self._all()
+        for dim, selected in selection.items():
+            if not selected or dim not in self.bitmaps:
+                continue
+            bits &= self._dim_bits(dim, selected)
+        return bits
+
+    def rows(self, selection: dict):
+        """Posições (iloc) das linhas que atendem a seleção."""
+        return np.flatnonzero(np.unpackbits(self.mask(selection), count=self.n))
+
+    def facets(self, selection: dict):
+        """Valores e contagens de cada dimensão dada a seleção nas demais.
+
+        Como em facetas de busca, a seleção da própria dimensão é ignorada.
+        As máscaras "todas menos i" saem de ANDs de prefixo/sufixo, então o
+        custo cresce linearmente com o número de dimensões.
+        """
+        dims = list(self.bitmaps)
+        ones = self._all()
+        sel_bits = [
+            self._dim_bits(d, selection[d]) if selection.get(d) else None
+            for d in dims
+        ]
+
+        prefix = [ones]
+        for bits in sel_bits:
+            prefix.append(prefix[-1] if bits is None else prefix[-1] & bits)
+        suffix = [ones]
+        for bits in reversed(sel_bits):
+            suffix.append(suffix[-1] if bits is None else suffix[-1] & bits)
+        suffix.reverse()
+
+        result = {}
+        for i, dim in enumerate(dims):
+            excl = prefix[i] & suffix[i + 1]
+            counts = POPCOUNT8[self.bitmaps[dim] & excl].sum(axis=1, dtype=np.int64)
+            result[dim] = dict(zip(self.values[dim], counts.tolist()))
+        return result
+
+class KpiCube:
+    """Cubo pré-agregado dos Indicadores Principais.
+
+    As células são as combinações distintas das dimensões de filtro (ano,
+    mês, município, bairro, monitorado, instalado, status). Vazão Estimada e
+    Caixas de apoio são somadas por célula. Para a "soma por poço sem
+    repetição" guarda um par (célula, well_id) com a primeira linha do poço
+    naquela célula, ordenado por poço e posição: a linha que o
+    drop_duplicates manteria é o primeiro par selecionado de cada poço. O
+    custo de uma consulta depende do tamanho do cubo, não do número de
+    linhas.
+    """
 
-def to_float(v):
-    if v is None:
+    def __init__(self, df: pd.DataFrame, fidx: FilterIndex):
+        n = len(df)
+        self.fidx = fidx
+        self.dims = list(fidx.codes)
+        if self.dims:
+            codes = np.column_stack([fidx.codes[d] for d in self.dims])
+        else:
+            codes = np.zeros((n, 1), dtype=np.int32)
+        self.cells, cell_of_row = np.unique(codes, axis=0, return_inverse=True)
+        cell_of_row = cell_of_row.ravel()
+        ncells = len(self.cells)
+
+        def num(col):
+            if col not in df.columns:
+                return np.zeros(n)
+            return df[col].to_numpy(dtype="float64", na_value=np.nan)
+
+        def cell_sum(weights, rows=slice(None)):
+            w = np.nan_to_num(weights[rows])
+            return np.bincount(cell_of_row[rows], weights=w, minlength=ncells)
+
+        tem_local = (
+            df["Localidade"].notna().to_numpy()
+            if "Localidade" in df.columns
+            else np.ones(n, dtype=bool)
+        )
+        vazao = num("Vazão_LH")
+
+        self.vazao_est = cell_sum(num("Vazão_estimada_LH"))
+        self.caixas = cell_sum(num("Caixas_apoio"))
+
+        # Primeira linha de cada (poço, célula), depois ordenada por poço e posição
+        well = df["well_id"].to_numpy()
+        pos = primeira_por_chave(well.astype(np.int64) * ncells + cell_of_row)
+        pos = pos[np.argsort(well[pos], kind="stable")]
+        self.pair_cell = cell_of_row[pos]
+        self.pair_well = well[pos]
+        self.pair_pocos = tem_local[pos]
+        self.pair_vazao = np.nan_to_num(vazao[pos])
+
+    def cell_mask(self, selection: dict):
+        mask = np.ones(len(self.cells), dtype=bool)
+        for i, dim in enumerate(self.dims):
+            selected = selection.get(dim)
+            if not selected:
+                continue
+            mask &= np.isin(self.cells[:, i], self.fidx.selected_codes(dim, selected))
+        return mask
+
+    def kpis(self, selection: dict) -> dict:
+        """Mesmos totais de calcula_kpis para a seleção {dimensão: valores}."""
+        cm = self.cell_mask(selection)
+        pm = cm[self.pair_cell]
+        wells = self.pair_well[pm]
+        primeiro = np.ones(len(wells), dtype=bool)
+        primeiro[1:] = wells[1:] != wells[:-1]
+        return {
+            "total_pocos": int(self.pair_pocos[pm][primeiro].sum()),
+            "total_vazao": float(self.pair_vazao[pm][primeiro].sum()),
+            "total_vazao_est": float(self.vazao_est[cm].sum()),
+            "total_caixas": float(self.caixas[cm].sum()),
+        }
+
+BAIRROS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bairros_pb.geojson")
+
+@st.cache_resource
+def le_bairros(path: str, mtime: float) -> dict:
+    """GeoJSON dos bairros, lido uma vez por processo (mtime invalida o cache)."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def arestas_poligonos(fc: dict, campo: str = "NM_BAIRRO"):
+    """Nome, bbox (xmin, ymin, xmax, ymax) e arestas (x1, y1, x2, y2) de cada feição.
+
+    Anéis externos e buracos entram juntos: a paridade do ray casting já
+    exclui os pontos dentro de buracos.
+    """
+    poligonos = []
+    for feat in fc.get("features", []):
+        g = feat.get("geometry") or {}
+        if g.get("type") == "Polygon":
+            partes = [g["coordinates"]]
+        elif g.get("type") == "MultiPolygon":
+            partes = g["coordinates"]
+        else:
+            continue
+        aneis = [np.asarray(anel, dtype="float64")[:, :2] for parte in partes for anel in parte if len(anel) >= 3]
+        if not aneis:
+            continue
+        arestas = np.concatenate([np.hstack([anel, np.roll(anel, -1, axis=0)]) for anel in aneis])
+        todos = np.concatenate(aneis)
+        poligonos.append((
+            (feat.get("properties") or {}).get(campo),
+            (*todos.min(axis=0), *todos.max(axis=0)),
+            arestas,
+        ))
+    return poligonos
+
+def pontos_em_poligonos(x, y, poligonos, max_celulas: int = 4_000_000):
+    """Índice do primeiro polígono que contém cada ponto (-1 se nenhum).
+
+    Filtra os candidatos pela bbox do polígono e faz o ray casting
+    vetorizado (pontos × arestas), em blocos de até max_celulas.
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    dono = np.full(len(x), -1, dtype=np.int32)
+    validos = np.isfinite(x) & np.isfinite(y)
+    for p, (_, (xmin, ymin, xmax, ymax), arestas) in enumerate(poligonos):
+        cand = np.flatnonzero(
+            validos & (dono < 0) & (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        )
+        if not len(cand):
+            continue
+        x1, y1, x2, y2 = (arestas[:, i] for i in range(4))
+        bloco = max(1, max_celulas // len(arestas))
+        for ini in range(0, len(cand), bloco):
+            c = cand[ini:ini + bloco]
+            px = x[c][:, None]
+            py = y[c][:, None]
+            cruza = (y1 > py) != (y2 > py)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                xc = (x2 - x1) * (py - y1) / (y2 - y1) + x1
+            dentro = np.count_nonzero(cruza & (px < xc), axis=1) % 2 == 1
+            dono[c[dentro]] = p
+    return dono
+
+def chave_nome(v) -> str:
+    """Nome comparável: sem acentos, minúsculo e sem espaços sobrando."""
+    if pd.isna(v):
+        return ""
+    v = unicodedata.normalize("NFKD", str(v))
+    return " ".join("".join(ch for ch in v if not unicodedata.combining(ch)).casefold().split())
+
+def atribui_bairros(df: pd.DataFrame, registry: "WellRegistry", fc: dict):
+    """Bairro de cada poço pelo polígono que o contém (NM_BAIRRO).
+
+    Poços dentro de um polígono passam a usar o nome do mapa em Bairro; os
+    demais mantêm o valor da planilha, que fica preservado em
+    Bairro_planilha. Devolve as divergências planilha × mapa por poço.
+    """
+    poligonos = arestas_poligonos(fc)
+    wells = registry.wells
+    dono = pontos_em_poligonos(
+        wells["longitude"].to_numpy(dtype="float64", na_value=np.nan),
+        wells["latitude"].to_numpy(dtype="float64", na_value=np.nan),
+        poligonos,
+    )
+    # Índice -1 (fora de todos os polígonos) cai no None do final
+    nomes = np.array([nome for nome, _, _ in poligonos] + [None], dtype=object)
+    geo = pd.Categorical(nomes[dono])
+    wells["Bairro_geo"] = geo
+
+    planilha = df["Bairro"] if "Bairro" in df.columns else pd.Series(pd.NA, index=df.index, dtype="category")
+    df["Bairro_planilha"] = planilha
+    geo_visita = pd.Series(geo.take(df["well_id"].to_numpy()), index=df.index)
+    cats = pd.Index(planilha.cat.categories).union(geo_visita.cat.categories)
+    df["Bairro"] = (
+        geo_visita.cat.set_categories(cats)
+        .fillna(planilha.cat.set_categories(cats))
+    )
+
+    # Divergências por poço: Bairro da planilha (primeira visita) × polígono
+    plan_poco = wells["Bairro"] if "Bairro" in wells.columns else pd.Series(pd.NA, index=wells.index)
+    comparar = pd.DataFrame({
+        "Bairro na planilha": plan_poco.astype("object"),
+        "Bairro no mapa": pd.Series(geo, index=wells.index).astype("object"),
+    })
+    comparar = comparar[comparar["Bairro no mapa"].notna()]
+    diverge = comparar[
+        comparar["Bairro na planilha"].map(chave_nome) != comparar["Bairro no mapa"].map(chave_nome)
+    ]
+    wells["Bairro"] = df["Bairro"].iloc[registry.visits[registry.offsets[:-1]]].to_numpy()
+    return (
+        diverge.fillna({"Bairro na planilha": "(vazio)"})
+        .groupby(["Bairro na planilha", "Bairro no mapa"])
+        .size()
+        .reset_index(name="Poços")
+        .sort_values("Poços", ascending=False, ignore_index=True)
+    )
+
+def prepare_dataset(raw: pd.DataFrame) -> dict:
+    """Normaliza a planilha bruta. Roda uma vez por versão dos dados, fora dos reruns."""
+    df = raw.copy()
+
+    date_formats = {}
+    if "Data_visita" in df.columns:
+        df["_Data_dt"], date_formats = parse_visit_dates(df["Data_visita"])
+        df["Ano_visita"] = df["_Data_dt"].dt.year.astype("Int16")
+        df["Mes_visita_num"] = df["_Data_dt"].dt.month.astype("Int8")
+        df["Mes_visita"] = pd.Categorical.from_codes(
+            df["Mes_visita_num"].fillna(0).astype("int8").to_numpy() - 1,
+            dtype=MESES_DTYPE,
+        )
+    else:
+        df["Ano_visita"] = None
+        df["Mes_visita"] = None
+
+    unmapped = normalize_categories(df, CATEGORY_MAPS)
+    df = compact_frame(df)
+    registry = WellRegistry(df)
+    df["well_id"] = registry.well_id
+
+    bairros_divergentes = None
+    if {"latitude", "longitude"} <= set(df.columns) and os.path.exists(BAIRROS_PATH):
+        bairros_divergentes = atribui_bairros(
+            df, registry, le_bairros(BAIRROS_PATH, os.path.getmtime(BAIRROS_PATH))
+        )
+
+    spatial = None
+    if {"latitude", "longitude"} <= set(registry.wells.columns):
+        spatial = SpatialIndex(
+            registry.wells["latitude"].to_numpy(dtype="float64", na_value=np.nan),
+            registry.wells["longitude"].to_numpy(dtype="float64", na_value=np.nan),
+        )
+
+    piramide = None
+    if spatial is not None:
+        piramide = PiramideClusters(spatial.lat, spatial.lon)
+
+    calor = None
+    if {"latitude", "longitude", "Vazão_LH"} <= set(df.columns):
+        calor = GradeCalor(
+            df["latitude"].to_numpy(dtype="float64", na_value=np.nan),
+            df["longitude"].to_numpy(dtype="float64", na_value=np.nan),
+            df["Vazão_LH"].to_numpy(dtype="float64", na_value=np.nan),
+        )
+
+    quadros = None
+    if calor is not None and df["Ano_visita"].notna().any():
+        quadros = QuadrosMensais(
+            calor,
+            df["Ano_visita"].to_numpy(dtype="float64", na_value=np.nan),
+            df["Mes_visita_num"].to_numpy(dtype="float64", na_value=np.nan),
+            (df["Status"] == "Instalado").fillna(False).to_numpy(dtype=bool)
+            if "Status" in df.columns
+            else np.zeros(len(df), dtype=bool),
+        )
+
+    filters = FilterIndex(df)
+    return {
+        "df": df,
+        "unmapped": unmapped,
+        "date_formats": date_formats,
+        "filters": filters,
+        "wells": registry,
+        "spatial": spatial,
+        "piramide": piramide,
+        "calor": calor,
+        "quadros": quadros,
+        "bairros_divergentes": bairros_divergentes,
+        "kpis": KpiCube(df, filters),
+    }
+
+# =============================
+# Visões filtradas (KPIs e agregados)
+# =============================
+# Orçamento de memória (MB) do cache LRU de visões compartilhado entre sessões
+VIEW_CACHE_MB = float(os.environ.get("VIEW_CACHE_MB", "64"))
+
+def calcula_kpis(base_df: pd.DataFrame) -> dict:
+    """KPIs calculados linha a linha (referência para conferir o KpiCube)."""
+    # Uma linha por poço (primeira visita filtrada de cada well_id)
+    kpi_pocos_df = base_df.iloc[primeira_por_chave(base_df["well_id"].to_numpy())]
+
+    total_pocos = (
+        kpi_pocos_df["Localidade"].notna().sum()
+        if "Localidade" in kpi_pocos_df.columns
+        else len(kpi_pocos_df)
+    )
+
+    # Vazão Medida: soma apenas uma vez por poço (well_id)
+    # Vazão Estimada e Caixas de apoio: soma nas medições filtradas (base_df)
+    return {
+        "total_pocos": int(total_pocos),
+        "total_vazao": safe_sum(kpi_pocos_df["Vazão_LH"]) if "Vazão_LH" in kpi_pocos_df.columns else 0,
+        "total_vazao_est": safe_sum(base_df["Vazão_estimada_LH"]) if "Vazão_estimada_LH" in base_df.columns else 0,
+        "total_caixas": safe_sum(base_df["Caixas_apoio"]) if "Caixas_apoio" in base_df.columns else 0,
+    }
+
+def agrega_status_ano(fdf: pd.DataFrame):
+    """Poços por ano da visita e Status (cada poço conta no máximo 1 vez por ano)."""
+    if "Status" not in fdf.columns or "Ano_visita" not in fdf.columns:
         return None
-    try:
-        return float(str(v).replace(",", "."))
-    except Exception:
+    tmp = fdf[["Ano_visita", "Status", "well_id"]].dropna(subset=["Ano_visita", "Status"])
+    chave = (
+        tmp["Ano_visita"].to_numpy(dtype=np.int64) * (int(fdf["well_id"].to_numpy().max(initial=0)) + 1)
+        + tmp["well_id"].to_numpy()
+    )
+    tmp = tmp.iloc[primeira_por_chave(chave)]
+
+    return (
+        tmp.groupby(["Ano_visita", "Status"], observed=True)
+        .size()
+        .reset_index(name="contagem")
+    )
+
+def agrega_contagem(fdf: pd.DataFrame, colname: str):
+    if colname not in fdf.columns:
+        return None
+    return (
+        fdf[[colname]]
+        .dropna()
+        .groupby(colname, observed=True)
+        .size()
+        .reset_index(name="contagem")
+    )
+
+def agrega_caixas_ano(fdf: pd.DataFrame):
+    if "Caixas_apoio" not in fdf.columns or "Ano_visita" not in fdf.columns:
         return None
+    return (
+        fdf[["Ano_visita", "Caixas_apoio"]]
+        .dropna(subset=["Ano_visita", "Caixas_apoio"])
+        .groupby("Ano_visita")["Caixas_apoio"]
+        .sum()
+        .reset_index(name="total_caixas")
+    )
+
+def visitas_por_poco(fdf: pd.DataFrame):
+    """Visitas ordenadas por poço e data (ordem, inícios dos grupos).
+
+    A última posição de cada grupo é a visita mais recente do poço; visitas
+    sem data ficam antes das datadas e empates seguem a ordem das linhas.
+    """
+    n = len(fdf)
+    well = fdf["well_id"].to_numpy()
+    if "_Data_dt" in fdf.columns:
+        data = fdf["_Data_dt"].to_numpy().view("i8")
+    else:
+        data = np.zeros(n, dtype=np.int64)
+    ordem = np.lexsort((np.arange(n), data, well))
+    w = well[ordem]
+    inicio = np.flatnonzero(np.r_[True, w[1:] != w[:-1]]) if n else np.zeros(0, dtype=np.intp)
+    return ordem, np.r_[inicio, n]
+
+def compute_view(dataset: dict, selection: dict) -> dict:
+    """Linhas filtradas, KPIs e agregados dos gráficos para uma seleção."""
+    rows = dataset["filters"].rows(selection).astype(np.int32)
+    rows.flags.writeable = False
+    fdf = dataset["df"].iloc[rows]
+    ordem, offsets = visitas_por_poco(fdf)
+    return {
+        "rows": rows,
+        # Camada do mapa: visita mais recente de cada poço + histórico por poço
+        "mapa": {
+            "latest": rows[ordem[offsets[1:] - 1]],
+            "hist": rows[ordem],
+            "offsets": offsets.astype(np.int32),
+        },
+        # Mapa de calor: agregados da grade fixa (soma, máximo e nº de visitas)
+        "calor": dataset["calor"].agrega(rows) if dataset["calor"] is not None else None,
+        "kpis": dataset["kpis"].kpis(selection),
+        "charts": {
+            "status_ano": agrega_status_ano(fdf),
+            "caixas_ano": agrega_caixas_ano(fdf),
+            "Status": agrega_contagem(fdf, "Status"),
+            "Monitorado": agrega_contagem(fdf, "Monitorado"),
+            "Instalado": agrega_contagem(fdf, "Instalado"),
+        },
+    }
+
+def filter_key(selection: dict):
+    """Forma canônica e hashável da seleção (ordem dos valores não importa)."""
+    return tuple(
+        (dim, tuple(sorted(str(v) for v in vals)))
+        for dim, vals in sorted(selection.items())
+        if vals
+    )
+
+def view_nbytes(value) -> int:
+    size = 1024
+    for v in value.values():
+        if isinstance(v, np.ndarray):
+            size += v.nbytes
+        elif isinstance(v, pd.DataFrame):
+            size += int(v.memory_usage(deep=True).sum())
+        elif isinstance(v, dict):
+            size += view_nbytes(v)
+    return size
+
+class ViewCache:
+    """Cache LRU de visões filtradas, compartilhado por todas as sessões.
+
+    A chave é (versão dos dados, seleção normalizada); as entradas menos
+    usadas são descartadas quando a soma estimada passa de budget_bytes.
+    """
+
+    def __init__(self, budget_bytes: float):
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.stats["hits"] += 1
+                return item[0]
+
+        value = compute()
+        size = view_nbytes(value)
+        with self._lock:
+            self.stats["misses"] += 1
+            if key not in self._items:
+                self._items[key] = (value, size)
+                self.nbytes += size
+            while self.nbytes > self.budget_bytes and len(self._items) > 1:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self.nbytes -= old_size
+                self.stats["evictions"] += 1
+        return value
+
+@st.cache_resource
+def get_view_cache():
+    return ViewCache(VIEW_CACHE_MB * 1e6)
 
 # =============================
 # Header Modernizado
@@ -410,103 +2065,110 @@ st.markdown("""
 # =============================
 col_info1, col_info2, col_info3 = st.columns([2,1,1])
 
-with col_info1:
-    st.caption(
-        f"🕐 Última atualização: {datetime.now(TZ).strftime('%d/%m/%Y %H:%M')} "
-        f"(Horário de Fortaleza)"
-    )
-
 with col_info2:
     st.caption("📊 Dados em tempo real")
 
 with col_info3:
     if st.button("🔄 Atualizar Dados"):
+        try:
+            get_sheet_cache(sheet_csv_url(SHEET_ID, GID), SEP).refresh(force=True)
+        except Exception:
+            pass  # o erro é exibido pelo carregamento logo abaixo
         st.rerun()
 
 # =============================
 # Carrega dados
 # =============================
-SHEET_ID = "12mU_58X2Ezlr_tG7pcinh1kGMY1xgXXXKfyOlXj75rc"
-GID = "1870024591"
-SEP = ","
-
 try:
-    df = load_from_gsheet_csv(SHEET_ID, GID, sep=SEP)
+    sheet_entry = load_from_gsheet_csv(SHEET_ID, GID, sep=SEP)
 except Exception:
     st.error("❌ Erro ao carregar dados da planilha. Verifique a conexão.")
     st.stop()
 
+sheet_cache = get_sheet_cache(sheet_csv_url(SHEET_ID, GID), SEP)
+dataset = sheet_entry["data"]
+data_version = sheet_entry["version"]
+df = dataset["df"]
+
+with col_info1:
+    # Momento em que a versão exibida foi baixada, não o horário do rerun
+    data_ts = sheet_entry["fetched_at"]
+    st.caption(
+        f"🕐 Última atualização: {data_ts.astimezone(TZ).strftime('%d/%m/%Y %H:%M')} "
+        f"(Horário de Fortaleza)"
+    )
+
 if df.empty:
     st.info("📋 Planilha sem dados disponíveis.")
     st.stop()
 
-df = df.replace({np.nan: None})
-
-if "Ano" in df.columns:
-    df["Ano"] = pd.to_numeric(df["Ano"], errors="coerce").astype("Int64")
-
-if "Data_visita" in df.columns:
-    df["_Data_dt"] = pd.to_datetime(df["Data_visita"], errors="coerce")
-    df["Ano_visita"] = df["_Data_dt"].dt.year
-    df["Mes_visita_num"] = df["_Data_dt"].dt.month
-    meses_map = {
-        1: "Jan", 2: "Fev", 3: "Mar", 4: "Abr",
-        5: "Mai", 6: "Jun", 7: "Jul", 8: "Ago",
-        9: "Set", 10: "Out", 11: "Nov", 12: "Dez",
-    }
-    df["Mes_visita"] = df["Mes_visita_num"].map(meses_map)
-else:
-    df["Ano_visita"] = None
-    df["Mes_visita"] = None
+# =============================
+# Filtros Modernizados
+# =============================
+st.markdown("### 🔍 Filtros Avançados")
 
-monitorado_map = {
-    "sim": "Sim",
-    "nao": "Não",
-    "não": "Não"
-}
-instalado_map = {
-    "sim": "Sim",
-    "nao": "Não",
-    "não": "Não"
-}
-status_map = {
-    "instalado": "Instalado",
-    "nao_instalado": "Não instalado",
-    "não_instalado": "Não instalado",
-    "desativado": "Desativado",
-    "obstruido": "Obstruído",
-    "obstruído": "Obstruído",
-    "injetado": "Injetado",
+fidx = dataset["filters"]
+
+# Dimensão -> (chave do multiselect, chave do toggle ou None se sempre ativo)
+FILTER_WIDGETS = {
+    "Ano_visita": ("f_ano", "tg_ano"),
+    "Mes_visita": ("f_mes", "tg_mes"),
+    "Município": ("f_mun", None),
+    "Bairro": ("f_bairro", None),
+    "Monitorado": ("f_mon", "tg_mon"),
+    "Instalado": ("f_inst", "tg_inst"),
+    "Status": ("f_status", None),
 }
 
-if "Monitorado" in df.columns:
-    df["Monitorado"] = df["Monitorado"].apply(
-        lambda v: monitorado_map.get(normaliza_lower(v), v)
-    )
+def filtro_todos(key: str) -> bool:
+    """Se o multiselect está em "todos" (estado inicial, até o usuário mudar a escolha)."""
+    return st.session_state.get(key + "_todos", True) or key not in st.session_state
 
-if "Instalado" in df.columns:
-    df["Instalado"] = df["Instalado"].apply(
-        lambda v: instalado_map.get(normaliza_lower(v), v)
-    )
+def selecao_widgets():
+    """Seleção atual de cada dimensão, lida do estado dos widgets (None = desligado).
 
-if "Status" in df.columns:
-    df["Status"] = df["Status"].apply(
-        lambda v: status_map.get(normaliza_lower(v), v)
+    "Todos" vale como todos os valores da versão atual dos dados, então valores
+    novos entram sozinhos; numa escolha do usuário, valores que sumiram saem.
+    """
+    selecao = {}
+    for dim, (key, toggle) in FILTER_WIDGETS.items():
+        valores = fidx.values.get(dim, [])
+        if toggle is not None and not st.session_state.get(toggle):
+            selecao[dim] = None
+        elif filtro_todos(key):
+            selecao[dim] = list(valores)
+        else:
+            existentes = set(valores)
+            selecao[dim] = [v for v in st.session_state[key] if v in existentes]
+    return selecao
+
+def marca_filtro_todos(key: str, opts: list):
+    st.session_state[key + "_todos"] = set(st.session_state[key]) == set(opts)
+
+# Facetas em uma passada: para cada dimensão, valores e contagem de linhas
+# considerando a seleção de todas as outras (a própria fica de fora)
+selecao = selecao_widgets()
+facetas = fidx.facets(selecao)
+
+def multiselect_facetado(label, dim, help=None):
+    key = FILTER_WIDGETS[dim][0]
+    contagens = facetas.get(dim, {})
+    todos = filtro_todos(key)
+    escolhidos = set() if todos else set(selecao.get(dim) or [])
+    # Só valores escolhidos pelo usuário continuam na lista com contagem zero
+    opts = [v for v in fidx.values.get(dim, []) if contagens.get(v, 0) > 0 or v in escolhidos]
+    # O estado é refeito a cada rerun: em "todos" acompanha as opções atuais
+    st.session_state[key] = opts if todos else [v for v in opts if v in escolhidos]
+    valor = st.multiselect(
+        label,
+        options=opts,
+        format_func=lambda v: f"{v} ({contagens.get(v, 0)})",
+        help=help,
+        key=key,
+        on_change=marca_filtro_todos,
+        args=(key, opts),
     )
-
-# =============================
-# Filtros Modernizados
-# =============================
-st.markdown("### 🔍 Filtros Avançados")
-
-# Inicializar session_state se necessário
-if 'filter_cache' not in st.session_state:
-    st.session_state.filter_cache = {
-        'ano_sel': None,
-        'mes_sel': None,
-        'mun_sel': None,
-        'bairro_sel': None
-    }
+    return selecao[dim] if todos else valor
 
 with st.expander("Filtros de Pesquisa", expanded=True):
     col_f1, col_f2, col_f3, col_f4 = st.columns(4)
@@ -515,166 +2177,48 @@ with st.expander("Filtros de Pesquisa", expanded=True):
     # Ano da visita (liga/desliga)
     # -------------------------
     with col_f1:
-        anos = []
-        if "Ano_visita" in df.columns:
-            anos = sorted([a for a in df["Ano_visita"].dropna().unique().tolist()])
+        anos = fidx.values.get("Ano_visita", [])
 
-        use_filter_ano = st.toggle("📅 Filtrar ano da visita", value=False)
+        use_filter_ano = st.toggle("📅 Filtrar ano da visita", value=False, key="tg_ano")
 
         if use_filter_ano and anos:
-            # Criar dataframe temporário para filtragem
-            df_temp = df.copy()
-            
-            # Aplicar filtros já selecionados
-            if st.session_state.filter_cache.get('mun_sel'):
-                if "Município" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-            
-            if st.session_state.filter_cache.get('bairro_sel'):
-                if "Bairro" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-            
-            if st.session_state.filter_cache.get('mes_sel'):
-                if "Mes_visita" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-            
-            # Obter anos disponíveis após filtros
-            if "Ano_visita" in df_temp.columns:
-                ano_opts = sorted([a for a in df_temp["Ano_visita"].dropna().unique().tolist()])
-            else:
-                ano_opts = anos
-            
-            ano_sel = st.multiselect(
-                "Ano da visita",
-                options=ano_opts,
-                default=ano_opts,
-                help="Selecione os anos de visita"
+            ano_sel = multiselect_facetado(
+                "Ano da visita", "Ano_visita", help="Selecione os anos de visita"
             )
-            st.session_state.filter_cache['ano_sel'] = ano_sel
         else:
             ano_sel = None
-            st.session_state.filter_cache['ano_sel'] = None
 
     # -------------------------
     # Mês da visita (liga/desliga)
     # -------------------------
     with col_f2:
-        meses_base = []
-        if "Mes_visita" in df.columns:
-            meses_base = [m for m in df["Mes_visita"].dropna().unique().tolist()]
+        meses_base = fidx.values.get("Mes_visita", [])
         
-        use_filter_mes = st.toggle("🗓️ Filtrar mês da visita", value=False)
+        use_filter_mes = st.toggle("🗓️ Filtrar mês da visita", value=False, key="tg_mes")
 
         if use_filter_mes and meses_base:
-            # Criar dataframe temporário para filtragem
-            df_temp = df.copy()
-            
-            # Aplicar filtros já selecionados
-            if st.session_state.filter_cache.get('mun_sel'):
-                if "Município" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-            
-            if st.session_state.filter_cache.get('bairro_sel'):
-                if "Bairro" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-            
-            if st.session_state.filter_cache.get('ano_sel'):
-                if "Ano_visita" in df_temp.columns:
-                    df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-            
-            # Obter meses disponíveis após filtros
-            if "Mes_visita" in df_temp.columns:
-                meses_filtrados = [m for m in df_temp["Mes_visita"].dropna().unique().tolist()]
-                if meses_filtrados:
-                    ordem_meses = ["Jan","Fev","Mar","Abr","Mai","Jun",
-                                   "Jul","Ago","Set","Out","Nov","Dez"]
-                    mes_opts = sorted(meses_filtrados, 
-                                     key=lambda x: ordem_meses.index(x) if x in ordem_meses else len(ordem_meses))
-                else:
-                    mes_opts = []
-            else:
-                ordem_meses = ["Jan","Fev","Mar","Abr","Mai","Jun",
-                               "Jul","Ago","Set","Out","Nov","Dez"]
-                mes_opts = sorted(meses_base, 
-                                 key=lambda x: ordem_meses.index(x) if x in ordem_meses else len(ordem_meses))
-            
-            mes_sel = st.multiselect(
-                "Mês da visita",
-                options=mes_opts,
-                default=mes_opts
-            )
-            st.session_state.filter_cache['mes_sel'] = mes_sel
+            # Ordem Jan..Dez vem da categoria ordenada
+            mes_sel = multiselect_facetado("Mês da visita", "Mes_visita")
         else:
             mes_sel = None
-            st.session_state.filter_cache['mes_sel'] = None
 
     # -------------------------
     # Município (sempre ativo) - AGORA COM FILTRAGEM CONDICIONAL
     # -------------------------
     with col_f3:
-        # Criar dataframe temporário para filtragem
-        df_temp = df.copy()
-        
-        # Aplicar filtros já selecionados
-        if st.session_state.filter_cache.get('ano_sel'):
-            if "Ano_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-        
-        if st.session_state.filter_cache.get('mes_sel'):
-            if "Mes_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-        
-        if st.session_state.filter_cache.get('bairro_sel'):
-            if "Bairro" in df_temp.columns:
-                df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-        
-        # Obter municípios disponíveis após filtros
-        if "Município" in df_temp.columns:
-            mun_opts = sorted([m for m in df_temp["Município"].dropna().unique().tolist()])
-        else:
-            mun_opts = []
-        
-        mun_sel = st.multiselect(
-            "🏙️ Município",
-            options=mun_opts,
-            default=mun_opts if mun_opts else None,
+        mun_sel = multiselect_facetado(
+            "🏙️ Município", "Município",
             help="Municípios disponíveis com base nos filtros aplicados"
         )
-        st.session_state.filter_cache['mun_sel'] = mun_sel
 
     # -------------------------
     # Bairro (sempre ativo) - FILTRADO POR MUNICÍPIO E OUTROS FILTROS
     # -------------------------
     with col_f4:
-        # Criar dataframe temporário para filtragem
-        df_temp = df.copy()
-        
-        # Aplicar filtros já selecionados
-        if st.session_state.filter_cache.get('ano_sel'):
-            if "Ano_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-        
-        if st.session_state.filter_cache.get('mes_sel'):
-            if "Mes_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-        
-        if st.session_state.filter_cache.get('mun_sel'):
-            if "Município" in df_temp.columns:
-                df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-        
-        # Obter bairros disponíveis após filtros
-        if "Bairro" in df_temp.columns:
-            bairro_opts = sorted([b for b in df_temp["Bairro"].dropna().unique().tolist()])
-        else:
-            bairro_opts = []
-        
-        bairro_sel = st.multiselect(
-            "📍 Bairro",
-            options=bairro_opts,
-            default=bairro_opts if bairro_opts else None,
+        bairro_sel = multiselect_facetado(
+            "📍 Bairro", "Bairro",
             help="Bairros disponíveis com base nos filtros aplicados"
         )
-        st.session_state.filter_cache['bairro_sel'] = bairro_sel
 
     # Segunda linha
     col_f5, col_f6, col_f7 = st.columns(3)
@@ -683,39 +2227,10 @@ with st.expander("Filtros de Pesquisa", expanded=True):
     # Monitorado pela COGERH (liga/desliga)
     # -------------------------
     with col_f5:
-        # Criar dataframe temporário para filtragem
-        df_temp = df.copy()
-        
-        # Aplicar filtros já selecionados
-        if st.session_state.filter_cache.get('ano_sel'):
-            if "Ano_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-        
-        if st.session_state.filter_cache.get('mes_sel'):
-            if "Mes_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-        
-        if st.session_state.filter_cache.get('mun_sel'):
-            if "Município" in df_temp.columns:
-                df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-        
-        if st.session_state.filter_cache.get('bairro_sel'):
-            if "Bairro" in df_temp.columns:
-                df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-        
-        if "Monitorado" in df_temp.columns:
-            mon_opts = sorted([m for m in df_temp["Monitorado"].dropna().unique().tolist()])
-        else:
-            mon_opts = []
+        use_filter_mon = st.toggle("📡 Filtrar Monitorado pela COGERH", value=False, key="tg_mon")
 
-        use_filter_mon = st.toggle("📡 Filtrar Monitorado pela COGERH", value=False)
-
-        if use_filter_mon and mon_opts:
-            mon_sel = st.multiselect(
-                "Monitorado pela COGERH",
-                options=mon_opts,
-                default=mon_opts
-            )
+        if use_filter_mon and facetas.get("Monitorado"):
+            mon_sel = multiselect_facetado("Monitorado pela COGERH", "Monitorado")
         else:
             mon_sel = None
 
@@ -723,39 +2238,10 @@ with st.expander("Filtros de Pesquisa", expanded=True):
     # Instalado / Estado (liga/desliga)
     # -------------------------
     with col_f6:
-        # Criar dataframe temporário para filtragem
-        df_temp = df.copy()
-        
-        # Aplicar filtros já selecionados
-        if st.session_state.filter_cache.get('ano_sel'):
-            if "Ano_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-        
-        if st.session_state.filter_cache.get('mes_sel'):
-            if "Mes_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-        
-        if st.session_state.filter_cache.get('mun_sel'):
-            if "Município" in df_temp.columns:
-                df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-        
-        if st.session_state.filter_cache.get('bairro_sel'):
-            if "Bairro" in df_temp.columns:
-                df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-        
-        if "Instalado" in df_temp.columns:
-            inst_opts = sorted([m for m in df_temp["Instalado"].dropna().unique().tolist()])
-        else:
-            inst_opts = []
+        use_filter_inst = st.toggle("⚙️ Filtrar Instalado/Estado", value=False, key="tg_inst")
 
-        use_filter_inst = st.toggle("⚙️ Filtrar Instalado/Estado", value=False)
-
-        if use_filter_inst and inst_opts:
-            inst_sel = st.multiselect(
-                "Instalado/Estado",
-                options=inst_opts,
-                default=inst_opts
-            )
+        if use_filter_inst and facetas.get("Instalado"):
+            inst_sel = multiselect_facetado("Instalado/Estado", "Instalado")
         else:
             inst_sel = None
 
@@ -763,118 +2249,71 @@ with st.expander("Filtros de Pesquisa", expanded=True):
     # Status (sempre ativo)
     # -------------------------
     with col_f7:
-        # Criar dataframe temporário para filtragem
-        df_temp = df.copy()
-        
-        # Aplicar filtros já selecionados
-        if st.session_state.filter_cache.get('ano_sel'):
-            if "Ano_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-        
-        if st.session_state.filter_cache.get('mes_sel'):
-            if "Mes_visita" in df_temp.columns:
-                df_temp = df_temp[df_temp["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-        
-        if st.session_state.filter_cache.get('mun_sel'):
-            if "Município" in df_temp.columns:
-                df_temp = df_temp[df_temp["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-        
-        if st.session_state.filter_cache.get('bairro_sel'):
-            if "Bairro" in df_temp.columns:
-                df_temp = df_temp[df_temp["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-        
-        if "Status" in df_temp.columns:
-            status_opts = sorted([s for s in df_temp["Status"].dropna().unique().tolist()])
-        else:
-            status_opts = []
-        
-        status_sel = st.multiselect(
-            "✅ Status",
-            options=status_opts,
-            default=status_opts if status_opts else None
-        )
+        status_sel = multiselect_facetado("✅ Status", "Status")
 
 # =============================
 # Aplicação dos filtros FINAL
 # =============================
-fdf = df.copy()
-
-# Aplicar filtros baseados nos toggles e seleções atuais
-if use_filter_ano and st.session_state.filter_cache.get('ano_sel'):
-    fdf = fdf[fdf["Ano_visita"].isin(st.session_state.filter_cache['ano_sel'])]
-
-if use_filter_mes and st.session_state.filter_cache.get('mes_sel'):
-    fdf = fdf[fdf["Mes_visita"].isin(st.session_state.filter_cache['mes_sel'])]
-
-if st.session_state.filter_cache.get('mun_sel'):
-    fdf = fdf[fdf["Município"].isin(st.session_state.filter_cache['mun_sel'])]
-
-if st.session_state.filter_cache.get('bairro_sel'):
-    fdf = fdf[fdf["Bairro"].isin(st.session_state.filter_cache['bairro_sel'])]
-
-if use_filter_mon and mon_sel:
-    fdf = fdf[fdf["Monitorado"].isin(mon_sel)]
-
-if use_filter_inst and inst_sel:
-    fdf = fdf[fdf["Instalado"].isin(inst_sel)]
-
-if status_sel:
-    fdf = fdf[fdf["Status"].isin(status_sel)]
+# Cada dimensão vira um OU dos bitmaps dos valores escolhidos; as dimensões
+# são combinadas com E. Seleção vazia ou None = filtro desligado.
+selecao_final = {
+    "Ano_visita": ano_sel,
+    "Mes_visita": mes_sel,
+    "Município": mun_sel,
+    "Bairro": bairro_sel,
+    "Monitorado": mon_sel,
+    "Instalado": inst_sel,
+    "Status": status_sel,
+}
 
+view_cache = get_view_cache()
+view = view_cache.get_or_compute(
+    (data_version, filter_key(selecao_final)),
+    lambda: compute_view(dataset, selecao_final),
+)
+fdf = df.iloc[view["rows"]]
 
+# Poços com alguma visita dentro dos filtros (máscara sobre well_id)
+pocos_visiveis = np.zeros(dataset["wells"].n_wells, dtype=bool)
+pocos_visiveis[df["well_id"].to_numpy()[view["mapa"]["latest"]]] = True
 
 # =============================
 # KPIs Modernizados
 # =============================
 st.markdown("### 📈 Indicadores Principais")
 
-# Base filtrada pelos Filtros Avançados
-base_df = fdf.copy()
-
-# Garante tipos numéricos nas colunas de interesse
-if "Vazão_LH" in base_df.columns:
-    base_df["Vazão_LH"] = pd.to_numeric(base_df["Vazão_LH"], errors="coerce")
-if "Vazão_estimada_LH" in base_df.columns:
-    base_df["Vazão_estimada_LH"] = pd.to_numeric(base_df["Vazão_estimada_LH"], errors="coerce")
-if "Caixas_apoio" in base_df.columns:
-    base_df["Caixas_apoio"] = pd.to_numeric(base_df["Caixas_apoio"], errors="coerce")
-
-# -----------------------------
-# Contagem de poços únicos (Latitude_2)
-# -----------------------------
-if "Latitude_2" in base_df.columns:
-    # Poços com coordenada (uma linha por Latitude_2)
-    non_null_lat = (
-        base_df[base_df["Latitude_2"].notna()]
-        .drop_duplicates(subset=["Latitude_2"])
-        .copy()
-    )
-    # Linhas sem Latitude_2 entram como registros avulsos
-    null_lat = base_df[base_df["Latitude_2"].isna()].copy()
-
-    kpi_pocos_df = pd.concat([non_null_lat, null_lat], ignore_index=True)
-else:
-    kpi_pocos_df = base_df.copy()
-
-# Garante Vazão_LH numérico também em kpi_pocos_df
-if "Vazão_LH" in kpi_pocos_df.columns:
-    kpi_pocos_df["Vazão_LH"] = pd.to_numeric(kpi_pocos_df["Vazão_LH"], errors="coerce")
-
-total_pocos = (
-    kpi_pocos_df["Localidade"].notna().sum()
-    if "Localidade" in kpi_pocos_df.columns
-    else len(kpi_pocos_df)
+so_area_visivel = st.toggle(
+    "🔲 Restringir indicadores e tabela à área visível do mapa", value=False, key="tg_area"
 )
 
-# -----------------------------
-# Somas numéricas (respeitando filtros)
-# -----------------------------
-# Vazão Medida: soma apenas uma vez por poço (Latitude_2)
-total_vazao = safe_sum(kpi_pocos_df["Vazão_LH"]) if "Vazão_LH" in kpi_pocos_df.columns else 0
+# Limites do mapa devolvidos pelo st_folium na interação anterior
+limites = (st.session_state.get("mapa") or {}).get("bounds") or {}
+sw, ne = limites.get("_southWest") or {}, limites.get("_northEast") or {}
+zoom_mapa = (st.session_state.get("mapa") or {}).get("zoom")
+caixa_mapa = None
+if all(isinstance(v, (int, float)) for v in (sw.get("lat"), sw.get("lng"), ne.get("lat"), ne.get("lng"))):
+    caixa_mapa = (sw["lat"], sw["lng"], ne["lat"], ne["lng"])
+
+fdf_area = fdf
+if so_area_visivel and dataset["spatial"] is not None:
+    if caixa_mapa is None:
+        st.caption("Mova ou aproxime o mapa para definir a área visível.")
+    else:
+        ids_area = dataset["spatial"].within_bbox(*caixa_mapa, permitido=pocos_visiveis)
+        na_area = np.zeros(len(pocos_visiveis), dtype=bool)
+        na_area[ids_area] = True
+        fdf_area = fdf[na_area[fdf["well_id"].to_numpy()]]
+        st.caption(
+            f"Área visível do mapa: {len(ids_area)} de {int(pocos_visiveis.sum())} poços filtrados."
+        )
 
-# Vazão Estimada e Caixas de apoio: soma nas medições filtradas (base_df)
-total_vazao_est = safe_sum(base_df["Vazão_estimada_LH"]) if "Vazão_estimada_LH" in base_df.columns else 0
-total_caixas = safe_sum(base_df["Caixas_apoio"]) if "Caixas_apoio" in base_df.columns else 0
+# KPIs da visão filtrada (calculados uma vez por combinação de filtros);
+# restritos à área do mapa, são recalculados linha a linha
+kpis = view["kpis"] if fdf_area is fdf else calcula_kpis(fdf_area)
+total_pocos = kpis["total_pocos"]
+total_vazao = kpis["total_vazao"]
+total_vazao_est = kpis["total_vazao_est"]
+total_caixas = kpis["total_caixas"]
 
 k1, k2, k3, k4 = st.columns(4)
 
@@ -931,6 +2370,651 @@ with k4:
     )
 
 
+# =============================
+# Camada de poços do mapa
+# =============================
+STATUS_COLORS = {
+    "Instalado": "#00b894",
+    "Não instalado": "#e17055",
+    "Desativado": "#636e72",
+    "Obstruído": "#d63031",
+    "Injetado": "#6c5ce7",
+}
+DEFAULT_COLOR = "#0984e3"
+
+MODOS_MAPA = (
+    "GeoJSON (uma camada)", "Marcadores individuais", "Filtro no navegador", "Agregado por zoom",
+)
+
+def extras_popup(mapa: dict, vazao_todas=None) -> list:
+    """HTML extra de cada poço: nº de visitas e, opcionalmente, sparkline de vazão."""
+    n_visitas = np.diff(mapa["offsets"])
+    extras = []
+    for k, n in enumerate(n_visitas):
+        if n <= 1:
+            extras.append("")
+            continue
+        extra = f'<div style="padding-top:8px;font-size:0.9em;">🔁 {n} visitas</div>'
+        if vazao_todas is not None:
+            hist = mapa["hist"][mapa["offsets"][k]:mapa["offsets"][k + 1]]
+            extra += sparkline_svg(vazao_todas[hist])
+        extras.append(extra)
+    return extras
+
+def tooltip_poco(localidade, status) -> str:
+    texto = str(localidade) if pd.notna(localidade) else "Poço"
+    if pd.notna(status) and status != "":
+        texto += f" • {status}"
+    return texto
+
+def camada_marcadores(mapa_df: pd.DataFrame, extras: list):
+    """Um CircleMarker com Popup próprio por poço (modo clássico).
+
+    O HTML dos popups sai do modelo compilado, com as colunas formatadas de
+    uma vez; o navegador só monta cada popup quando ele é aberto (lazy).
+    """
+    fg_pocos = folium.FeatureGroup(name="Poços (Status)", show=True)
+
+    lat = mapa_df["latitude"].to_numpy(dtype="float64", na_value=np.nan)
+    lon = mapa_df["longitude"].to_numpy(dtype="float64", na_value=np.nan)
+    status = mapa_df["Status"].tolist() if "Status" in mapa_df.columns else [None] * len(mapa_df)
+    local = mapa_df["Localidade"].tolist() if "Localidade" in mapa_df.columns else [None] * len(mapa_df)
+    popups = popups_html(mapa_df, extras)
+
+    for k in np.flatnonzero(np.isfinite(lat) & np.isfinite(lon)).tolist():
+        color = STATUS_COLORS.get(str(status[k]), DEFAULT_COLOR) if pd.notna(status[k]) else DEFAULT_COLOR
+
+        folium.CircleMarker(
+            location=[lat[k], lon[k]],
+            radius=10,
+            color=color,
+            fill=True,
+            fill_color=color,
+            fill_opacity=0.9,
+            popup=folium.Popup(popups[k], max_width=360, lazy=True),
+            tooltip=tooltip_poco(local[k], status[k]),
+            weight=2
+        ).add_to(fg_pocos)
+    return fg_pocos
+
+# Modelo único de popup: o mesmo HTML de make_popup_html com [[campo]] no
+# lugar dos valores, preenchido no navegador a partir das propriedades
+# (chaves duplas seriam consumidas pelo Jinja do folium)
+POPUP_TEMPLATE = make_popup_html(
+    pd.Series({col: "[[" + col + "]]" for col, _ in POPUP_CAMPOS}),
+    extra="[[_extra]]",
+)
+
+POCOS_GEOJSON_JS = r"""
+function(feature, layer) {
+    var p = feature.properties;
+    var cor = %(cores)s[p.Status] || %(padrao)s;
+    layer.setStyle({color: cor, fillColor: cor});
+    var esc = function(v) {
+        return String(v).replace(/[&<>"]/g, function(c) {
+            return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+        });
+    };
+    layer.bindTooltip(esc(p._tooltip));
+    layer.bindPopup(function() {
+        return %(modelo)s.replace(/\[\[([^\]]+)\]\]/g, function(_, campo) {
+            if (campo === "_extra") return p._extra || "";
+            return campo in p ? esc(p[campo]) : "-";
+        });
+    }, {maxWidth: 360});
+}
+"""
+
+def geojson_pocos(mapa_df: pd.DataFrame, extras: list) -> dict:
+    """FeatureCollection com um ponto por poço e os textos do popup nas propriedades."""
+    lat = mapa_df["latitude"].to_numpy(dtype="float64", na_value=np.nan)
+    lon = mapa_df["longitude"].to_numpy(dtype="float64", na_value=np.nan)
+    ok = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+
+    cols = [col for col, _ in POPUP_CAMPOS if col in mapa_df.columns]
+    valores = {col: fmt_popup_coluna(col, mapa_df[col]).tolist() for col in cols}
+    status = mapa_df["Status"].tolist() if "Status" in mapa_df.columns else [None] * len(mapa_df)
+    local = mapa_df["Localidade"].tolist() if "Localidade" in mapa_df.columns else [None] * len(mapa_df)
+    wid = mapa_df["well_id"].to_numpy()
+
+    features = []
+    for k in ok.tolist():
+        props = {col: valores[col][k] for col in cols}
+        props["Status"] = "" if pd.isna(status[k]) else str(status[k])
+        props["_tooltip"] = tooltip_poco(local[k], status[k])
+        props["_wid"] = int(wid[k])
+        if extras[k]:
+            props["_extra"] = extras[k]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(lon[k], 6), round(lat[k], 6)]},
+            "properties": props,
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def camada_geojson(mapa_df: pd.DataFrame, extras: list, dados=None):
+    """Todos os poços numa única camada GeoJSON.
+
+    Cor por Status, tooltip e popup são montados no navegador por uma só
+    função, a partir das propriedades de cada feição e de POPUP_TEMPLATE.
+    """
+    js = POCOS_GEOJSON_JS % {
+        "cores": json.dumps(STATUS_COLORS, ensure_ascii=False),
+        "padrao": json.dumps(DEFAULT_COLOR),
+        "modelo": json.dumps(POPUP_TEMPLATE, ensure_ascii=False),
+    }
+    return GeoJson(
+        dados if dados is not None else geojson_pocos(mapa_df, extras),
+        name="Poços (Status)",
+        marker=folium.CircleMarker(radius=10, fill=True, fill_opacity=0.9, weight=2),
+        on_each_feature=JsCode(js),
+    )
+
+def camada_pocos(modo: str, mapa_df: pd.DataFrame, extras: list):
+    if modo == MODOS_MAPA[1]:
+        return camada_marcadores(mapa_df, extras)
+    return camada_geojson(mapa_df, extras)
+
+# =============================
+# Mapa base e filtro no navegador
+# =============================
+# Zoom em que os limites simplificados não devem ter erro visível (meio pixel).
+# A camada vai uma vez só no HTML do mapa e vale para todos os zooms: abaixo
+# deste o erro some; acima, dobra a cada nível
+BAIRROS_ZOOM = int(os.environ.get("BAIRROS_ZOOM", "15"))
+# Propriedades que o mapa usa; as demais (~20 por feição) não vão para o navegador
+BAIRROS_PROPS = ("NM_BAIRRO", "CD_BAIRRO", "NM_MUN")
+
+def douglas_peucker(xy: np.ndarray, tol: float) -> np.ndarray:
+    """Máscara dos vértices mantidos por Douglas-Peucker.
+
+    Processa todos os segmentos abertos de um nível de uma vez (numpy), em
+    vez de um segmento por iteração; o custo por nível é linear no nº de
+    vértices.
+    """
+    n = len(xy)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    ini = np.array([0])
+    fim = np.array([n - 1])
+    while len(ini):
+        abertos = fim > ini + 1
+        ini, fim = ini[abertos], fim[abertos]
+        if not len(ini):
+            break
+        tam = fim - ini - 1
+        comeco = np.cumsum(tam) - tam
+        seg = np.repeat(np.arange(len(ini)), tam)
+        idx = np.arange(int(tam.sum())) - np.repeat(comeco, tam) + np.repeat(ini + 1, tam)
+
+        a = xy[ini][seg]
+        ab = xy[fim][seg] - a
+        ap = xy[idx] - a
+        norma = np.hypot(ab[:, 0], ab[:, 1])
+        cruz = np.abs(ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0])
+        d = np.where(norma > 0, cruz / np.where(norma > 0, norma, 1), np.hypot(ap[:, 0], ap[:, 1]))
+
+        # Vértice mais distante de cada segmento
+        ordem = np.lexsort((d, seg))
+        mais_longe = ordem[comeco + tam - 1]
+        divide = d[mais_longe] > tol
+        k = idx[mais_longe][divide]
+        keep[k] = True
+        ini, fim = np.r_[ini[divide], k], np.r_[k, fim[divide]]
+    return keep
+
+def simplifica_anel(anel, tol: float, casas: int):
+    """Simplifica e quantiza um anel fechado; None se ele degenerar."""
+    pts = np.asarray(anel, dtype="float64")
+    # Distâncias isotrópicas: longitude escalada pelo cosseno da latitude
+    xy = pts * [np.cos(np.deg2rad(pts[:, 1].mean())), 1.0]
+    # Anel fechado: divide no vértice mais distante do primeiro
+    k = int(np.argmax(np.hypot(*(xy - xy[0]).T)))
+    keep = np.zeros(len(pts), dtype=bool)
+    if 0 < k < len(pts) - 1:
+        keep[:k + 1] |= douglas_peucker(xy[:k + 1], tol)
+        keep[k:] |= douglas_peucker(xy[k:], tol)
+    else:
+        keep[:] = True
+    q = np.round(pts[keep], casas)
+    # Vértices repetidos após a quantização
+    q = q[np.r_[True, np.any(q[1:] != q[:-1], axis=1)]]
+    if len(q) < 4:
+        return None
+    return q.tolist()
+
+def simplifica_geometria(geom: dict, tol: float, casas: int):
+    if geom["type"] == "Polygon":
+        poligonos = [geom["coordinates"]]
+    elif geom["type"] == "MultiPolygon":
+        poligonos = geom["coordinates"]
+    else:
+        return geom
+    saida = []
+    for poligono in poligonos:
+        aneis = [simplifica_anel(anel, tol, casas) for anel in poligono]
+        if aneis and aneis[0] is not None:
+            saida.append([anel for anel in aneis if anel is not None])
+    if not saida:
+        return None
+    if geom["type"] == "Polygon":
+        return {"type": "Polygon", "coordinates": saida[0]}
+    return {"type": "MultiPolygon", "coordinates": saida}
+
+def conta_vertices(fc: dict) -> int:
+    n = 0
+    for feat in fc["features"]:
+        g = feat.get("geometry") or {}
+        aneis = [g["coordinates"]] if g.get("type") == "Polygon" else g.get("coordinates", [])
+        if g.get("type") in ("Polygon", "MultiPolygon"):
+            n += sum(len(anel) for poligono in aneis for anel in poligono)
+    return n
+
+@st.cache_resource(max_entries=8)
+def camada_bairros_dados(path: str, mtime: float, zoom: int) -> dict:
+    """Bairros simplificados e quantizados para um zoom, já com o relatório de tamanho.
+
+    A tolerância é meio pixel no zoom pedido e as coordenadas são
+    quantizadas na grade decimal correspondente (como o quantize do
+    TopoJSON), mas a saída continua GeoJSON para o Leaflet usar direto.
+    """
+    original = le_bairros(path, mtime)
+    tol = 0.5 * 360.0 / (256 * 2 ** zoom)
+    casas = max(0, int(math.ceil(-math.log10(tol))))
+
+    features = []
+    for feat in original["features"]:
+        geom = simplifica_geometria(feat["geometry"], tol, casas) if feat.get("geometry") else None
+        if geom is None:
+            continue
+        props = {k: v for k, v in (feat.get("properties") or {}).items() if k in BAIRROS_PROPS}
+        features.append({"type": "Feature", "geometry": geom, "properties": props})
+    simples = {"type": "FeatureCollection", "features": features}
+
+    texto = json.dumps(simples, ensure_ascii=False, separators=(",", ":"))
+    return {
+        "geojson": simples,
+        "bytes_antes": os.path.getsize(path),
+        "bytes_depois": len(texto.encode("utf-8")),
+        "vertices_antes": conta_vertices(original),
+        "vertices_depois": conta_vertices(simples),
+        "zoom": zoom,
+    }
+
+def camada_bairros(zoom: int = BAIRROS_ZOOM) -> dict:
+    return camada_bairros_dados(BAIRROS_PATH, os.path.getmtime(BAIRROS_PATH), zoom)
+
+def mapa_base():
+    """Mapa com as camadas de fundo e os bairros (sem poços)."""
+    fmap = folium.Map(
+        location=[-5.45, -39.7],
+        zoom_start=11,
+        control_scale=True,
+        tiles=None
+    )
+
+    folium.TileLayer("CartoDB Positron", name="CartoDB Positron").add_to(fmap)
+    folium.TileLayer("OpenStreetMap", name="OpenStreetMap").add_to(fmap)
+    folium.TileLayer(
+        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        name="Imagem de Satélite",
+        attr="Tiles © Esri"
+    ).add_to(fmap)
+
+    # Camada bairros
+    try:
+        GeoJson(
+            camada_bairros()["geojson"],
+            name="Bairros de Pedra Branca",
+            style_function=lambda feat: {
+                "color": "#00b894",
+                "weight": 2,
+                "fillColor": "#00b894",
+                "fillOpacity": 0.05,
+            },
+            tooltip=GeoJsonTooltip(
+                fields=["NM_BAIRRO"],
+                aliases=["Bairro:"],
+                sticky=False
+            )
+        ).add_to(fmap)
+    except Exception as e:
+        st.warning(f"⚠️ Camada de bairros não disponível: {e}")
+    return fmap
+
+AGREGACOES_CALOR = ("Soma", "Média", "Máximo")
+
+def pontos_calor(grade: GradeCalor, calor: dict, agregacao: str) -> list:
+    """[lat, lon, peso] por célula não vazia da grade, com peso normalizado em (0, 1]."""
+    if agregacao == "Média":
+        peso = calor["soma"] / calor["n"]
+    elif agregacao == "Máximo":
+        peso = calor["max"]
+    else:
+        peso = calor["soma"]
+    ok = peso > 0
+    if not ok.any():
+        return []
+    lat, lon = grade.centros(calor["celulas"][ok])
+    peso = peso[ok] / peso[ok].max()
+    return np.column_stack([lat.round(6), lon.round(6), peso.round(4)]).tolist()
+
+class HeatMapMensal(HeatMapWithTime):
+    """HeatMapWithTime com os limites dados na criação.
+
+    O _get_self_bounds do folium trata cada quadro como um ponto e quebra
+    quando o st_folium pede os limites do mapa.
+    """
+
+    def __init__(self, data, limites, **kwargs):
+        super().__init__(data, **kwargs)
+        self.limites = limites
+
+    def _get_self_bounds(self):
+        return self.limites
+
+def camada_quadros(quadros: QuadrosMensais, agregado: dict):
+    """Animação do mapa de calor com um quadro por mês (pesos na escala de todos os meses)."""
+    lat, lon = quadros.centros(agregado["celula"])
+    peso = agregado["peso"]
+    peso = peso / peso.max() if len(peso) else peso
+    pontos = np.column_stack([lat.round(5), lon.round(5), peso.round(3)])
+    # Os pares já vêm ordenados por quadro (a chave começa pelo quadro)
+    limites = np.searchsorted(agregado["quadro"], np.arange(len(quadros.rotulos) + 1))
+    dados = [pontos[a:b].tolist() for a, b in zip(limites[:-1], limites[1:])]
+    caixa = [[None, None], [None, None]]
+    if len(pontos):
+        caixa = [[float(lat.min()), float(lon.min())], [float(lat.max()), float(lon.max())]]
+    return HeatMapMensal(
+        dados,
+        caixa,
+        index=quadros.rotulos,
+        name="Evolução mensal",
+        radius=25,
+        max_opacity=0.8,
+        gradient={0.4: 'blue', 0.65: 'lime', 1: 'red'},
+        auto_play=False,
+    ), dados
+
+def camada_calor(heat_points):
+    fg_heat = folium.FeatureGroup(name="Mapa de Calor - Vazão", show=False)
+    heat = HeatMap(
+        heat_points,
+        radius=25,
+        blur=20,
+        max_zoom=12,
+        gradient={0.4: 'blue', 0.65: 'lime', 1: 'red'}
+    )
+    heat.add_to(fg_heat)
+    return fg_heat
+
+def ajusta_limites(fmap, mapa_df: pd.DataFrame):
+    lats = mapa_df["latitude"].to_numpy(dtype="float64", na_value=np.nan)
+    lons = mapa_df["longitude"].to_numpy(dtype="float64", na_value=np.nan)
+    if np.isfinite(lats).any() and np.isfinite(lons).any():
+        fmap.fit_bounds([
+            [float(np.nanmin(lats)), float(np.nanmin(lons))],
+            [float(np.nanmax(lats)), float(np.nanmax(lons))],
+        ])
+
+# Legenda com opção de recolher
+LEGEND_HTML = """
+{% macro html(this, kwargs) %}
+<div id="legend-pocos" style="
+    position: fixed;
+    bottom: 40px;
+    left: 10px;
+    z-index: 9999;
+    background: rgba(255,255,255,0.95);
+    padding: 12px 16px;
+    border: 1px solid #ddd;
+    border-radius: 16px;
+    font-size: 12px;
+    box-shadow: 0 4px 20px rgba(0,0,0,0.15);
+    backdrop-filter: blur(10px);
+    font-family: 'Segoe UI', system-ui, sans-serif;
+">
+  <div id="legend-pocos-header" style="font-weight:700; margin-bottom:6px; color:#2d3436; font-size:13px; cursor:pointer;"
+       onclick="
+         var body = document.getElementById('legend-pocos-body');
+         if (body.style.display === 'none') {
+             body.style.display = 'block';
+             this.innerHTML = 'Status dos Poços ▾';
+         } else {
+             body.style.display = 'none';
+             this.innerHTML = 'Status dos Poços ▸';
+         }
+       ">
+    Status dos Poços ▾
+  </div>
+  <div id="legend-pocos-body" style="margin-top:4px;">
+    <div style="display:flex;align-items:center;margin-bottom:4px;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#00b894;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Instalado
+    </div>
+    <div style="display:flex;align-items:center;margin-bottom:4px;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#e17055;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Não instalado
+    </div>
+    <div style="display:flex;align-items:center;margin-bottom:4px;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#636e72;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Desativado
+    </div>
+    <div style="display:flex;align-items:center;margin-bottom:4px;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#d63031;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Obstruído
+    </div>
+    <div style="display:flex;align-items:center;margin-bottom:4px;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#6c5ce7;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Injetado
+    </div>
+    <div style="display:flex;align-items:center;">
+      <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#0984e3;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Outros
+    </div>
+  </div>
+</div>
+{% endmacro %}
+"""
+
+def finaliza_mapa(fmap):
+    legend = MacroElement()
+    legend._template = Template(LEGEND_HTML)
+    fmap.get_root().add_child(legend)
+
+    # ⬇️ Botão de camadas recolhido (apenas ícone)
+    LayerControl(collapsed=True).add_to(fmap)
+
+CLIENTE_JS = """
+{% macro script(this, kwargs) %}
+    (function() {
+        var c = {
+            grupo: {{ this.grupo.get_name() }},
+            calor: {{ this.calor.get_name() }},
+            mapa: {{ this._parent.get_name() }},
+            poco_da_visita: {{ this.poco_da_visita|tojson }},
+            camadas: {}
+        };
+        c.grupo.eachLayer(function(l) { c.camadas[l.feature.properties._wid] = l; });
+        window.__pocosCliente = c;
+
+        // mascara: bits (np.packbits, base64) das visitas que passam nos filtros;
+        // calor: [lat, lon, peso] da grade agregada no servidor (pontos_calor)
+        window.aplicaFiltroPocos = function(mascara, calor) {
+            var bits = atob(mascara), w = c.poco_da_visita, pocos = {};
+            for (var i = 0; i < w.length; i++) {
+                if ((bits.charCodeAt(i >> 3) >> (7 - (i & 7))) & 1) pocos[w[i]] = true;
+            }
+            var limites = L.latLngBounds([]);
+            for (var wid in c.camadas) {
+                var l = c.camadas[wid];
+                if (pocos[wid]) {
+                    if (!c.grupo.hasLayer(l)) c.grupo.addLayer(l);
+                    limites.extend(l.getLatLng());
+                } else if (c.grupo.hasLayer(l)) {
+                    c.grupo.removeLayer(l);
+                }
+            }
+            c.calor.setLatLngs(calor);
+            if (limites.isValid()) c.mapa.fitBounds(limites);
+        };
+    })();
+{% endmacro %}
+"""
+
+FILTRO_JS = """
+{% macro script(this, kwargs) %}
+    window.aplicaFiltroPocos({{ this.mascara|tojson }}, {{ this.calor|tojson }});
+{% endmacro %}
+"""
+
+@st.cache_resource(max_entries=4)
+def dados_mapa_cliente(_dataset: dict, versao: str, mostrar_historico: bool):
+    """Poços (todas as visitas) e o poço de cada visita de uma versão dos dados.
+
+    Compartilhado entre sessões; o folium.Map é remontado a cada rerun a
+    partir destes dados (um mapa já renderizado não gera o mesmo script de
+    novo), e como o resultado é idêntico o navegador não refaz o mapa.
+    """
+    df = _dataset["df"]
+    todos = get_view_cache().get_or_compute(
+        (versao, filter_key({})), lambda: compute_view(_dataset, {})
+    )["mapa"]
+    mapa_df = df.iloc[todos["latest"]]
+    vazao = (
+        df["Vazão_LH"].to_numpy(dtype="float64", na_value=np.nan)
+        if "Vazão_LH" in df.columns
+        else np.full(len(df), np.nan)
+    )
+    extras = extras_popup(todos, vazao if mostrar_historico else None)
+    return mapa_df, extras, geojson_pocos(mapa_df, extras), df["well_id"].tolist()
+
+def mapa_cliente(dataset: dict, versao: str, mostrar_historico: bool):
+    """Mapa completo de uma versão dos dados: todos os poços + o poço de cada visita.
+
+    O filtro é aplicado no navegador (aplicaFiltroPocos) a partir de uma
+    máscara de visitas, sem recriar o mapa Leaflet. O st_folium manda o
+    script do mapa e o grupo dinâmico no mesmo componente, então cada
+    mudança de filtro ainda reenvia o mapa inteiro.
+    """
+    mapa_df, extras, dados, poco_da_visita = dados_mapa_cliente(dataset, versao, mostrar_historico)
+
+    fmap = mapa_base()
+    grupo = camada_geojson(mapa_df, extras, dados)
+    grupo.add_to(fmap)
+    fg_heat = camada_calor([])
+    fg_heat.add_to(fmap)
+    ajusta_limites(fmap, mapa_df)
+
+    registro = MacroElement()
+    registro._template = Template(CLIENTE_JS)
+    registro.grupo = grupo
+    registro.calor = next(iter(fg_heat._children.values()))
+    registro.poco_da_visita = poco_da_visita
+    fmap.add_child(registro)
+
+    finaliza_mapa(fmap)
+    return fmap, mapa_df, extras
+
+def camada_filtro_cliente(rows, n: int, calor: list):
+    """Grupo dinâmico do st_folium com a máscara das visitas filtradas e a grade de calor."""
+    marca = np.zeros(n, dtype=bool)
+    marca[rows] = True
+    filtro = MacroElement()
+    filtro._template = Template(FILTRO_JS)
+    filtro.mascara = base64.b64encode(np.packbits(marca).tobytes()).decode("ascii")
+    filtro.calor = calor
+    fg = folium.FeatureGroup(name="Filtro", control=False)
+    fg.add_child(filtro)
+    return fg
+
+# =============================
+# Mapa por área visível (agregados por zoom)
+# =============================
+def zoom_para_caixa(caixa, largura_px: int = 700, altura_px: int = 500) -> int:
+    """Maior zoom em que a caixa cabe num mapa do tamanho dado (antes do 1º retorno do mapa)."""
+    lat_min, lon_min, lat_max, lon_max = caixa
+    x0, y1 = mercator_px(lat_min, lon_min, 0)
+    x1, y0 = mercator_px(lat_max, lon_max, 0)
+    escala = min(largura_px / max(x1 - x0, 1e-9), altura_px / max(y1 - y0, 1e-9))
+    return int(np.clip(np.floor(np.log2(escala)), 0, 18))
+
+def mapa_area_visivel(dataset: dict):
+    """Mapa base de uma versão dos dados; os poços vêm de camada_area_visivel."""
+    fmap = mapa_base()
+    ajusta_limites(fmap, dataset["wells"].wells)
+    finaliza_mapa(fmap)
+    return fmap
+
+# Agregados numa única camada GeoJSON: o ícone (círculo com a contagem) e o
+# tooltip são montados no navegador a partir de n, d (diâmetro) e tip
+AGRUPAMENTO_JS = """
+function(feature, layer) {
+    var p = feature.properties;
+    layer.setIcon(L.divIcon({
+        html: '<div style="width:' + p.d + 'px;height:' + p.d + 'px;line-height:' + p.d
+            + 'px;border-radius:50%;background:rgba(9,132,227,0.75);border:2px solid #fff;'
+            + 'color:#fff;font-weight:600;font-size:12px;text-align:center;">' + p.n + '</div>',
+        className: "",
+        iconSize: [p.d, p.d],
+        iconAnchor: [p.d / 2, p.d / 2]
+    }));
+    layer.bindTooltip(p.tip);
+}
+"""
+
+def camada_agrupamentos(lat, lon, n, soma):
+    """Uma feição por agregado com a contagem e a vazão somada."""
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(float(lon[k]), 6), round(float(lat[k]), 6)]},
+            "properties": {
+                "n": int(n[k]),
+                "d": int(26 + 10 * math.log10(n[k])),
+                "tip": f"{n[k]} poços • {soma[k]:,.0f} L/h".replace(",", "."),
+            },
+        }
+        for k in range(len(n))
+    ]
+    return GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name="Agrupamentos",
+        marker=folium.Marker(),
+        on_each_feature=JsCode(AGRUPAMENTO_JS),
+    )
+
+def camada_area_visivel(dataset: dict, mapa_df: pd.DataFrame, extras: list, caixa, zoom: int):
+    """Grupo dinâmico do st_folium com o conteúdo da área visível do mapa.
+
+    A partir de ZOOM_POCOS vão só os poços dentro da área; abaixo dele, um
+    agregado (centróide, nº de poços e vazão somada) por célula da pirâmide
+    que toca a área, e células com um só poço vão como o próprio poço.
+    Assim o tamanho do envio depende da densidade da área, não do total.
+    """
+    spatial, piramide = dataset["spatial"], dataset["piramide"]
+    wid = mapa_df["well_id"].to_numpy()
+    pos = np.full(dataset["wells"].n_wells, -1, dtype=np.intp)
+    pos[wid] = np.arange(len(wid))
+    visiveis = pos >= 0
+
+    fg = folium.FeatureGroup(name="Poços (área visível)", control=False)
+    grupos = 0
+    if zoom >= ZOOM_POCOS:
+        soltos = spatial.within_bbox(*caixa, permitido=visiveis)
+    else:
+        ids = spatial.within_bbox(*piramide.caixa_celulas(zoom, caixa), permitido=visiveis)
+        vazao = np.full(len(pos), np.nan)
+        if "Vazão_LH" in mapa_df.columns:
+            vazao[wid] = mapa_df["Vazão_LH"].to_numpy(dtype="float64", na_value=np.nan)
+        lat, lon, n, soma, agrupados, offsets = piramide.agrega(zoom, ids, vazao)
+
+        unicos = n == 1
+        soltos = np.sort(agrupados[offsets[:-1][unicos]])
+        grupos = int((~unicos).sum())
+        if grupos:
+            varios = ~unicos
+            camada_agrupamentos(lat[varios], lon[varios], n[varios], soma[varios]).add_to(fg)
+
+    if len(soltos):
+        k = pos[soltos]
+        camada_geojson(mapa_df.iloc[k], [extras[i] for i in k]).add_to(fg)
+    return fg, {"pocos": len(soltos), "agrupamentos": grupos}
+
 # =============================
 # Layout Mapa + Fotos
 # =============================
@@ -943,181 +3027,99 @@ map_data = None
 
 with col_map:
     st.markdown("#### Mapa Interativo dos Poços")
-    
-    with st.container():
-        fmap = folium.Map(
-            location=[-5.45, -39.7],
-            zoom_start=11,
-            control_scale=True,
-            tiles=None
+    mc1, mc2 = st.columns([1.4, 1])
+    with mc1:
+        modo_mapa = st.radio(
+            "Renderização", MODOS_MAPA, horizontal=True, key="modo_mapa",
+            label_visibility="collapsed",
+        )
+    with mc2:
+        mostrar_historico = st.toggle("📈 Histórico de vazão no popup", value=False, key="tg_hist")
+        agregacao_calor = st.selectbox(
+            "🔥 Intensidade do mapa de calor", AGREGACOES_CALOR, key="agg_calor",
+            help="Vazão das visitas em cada célula da grade: soma, média ou máximo",
         )
 
-        folium.TileLayer("CartoDB Positron", name="CartoDB Positron").add_to(fmap)
-        folium.TileLayer("OpenStreetMap", name="OpenStreetMap").add_to(fmap)
-        folium.TileLayer(
-            tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-            name="Imagem de Satélite",
-            attr="Tiles © Esri"
-        ).add_to(fmap)
+    with st.container():
+        lat_col = "latitude" if "latitude" in fdf.columns else None
+        lon_col = "longitude" if "longitude" in fdf.columns else None
 
-        # Camada bairros
-        try:
-            with open("bairros_pb.geojson", "r", encoding="utf-8") as f:
-                bairros = json.load(f)
-            GeoJson(
-                bairros,
-                name="Bairros de Pedra Branca",
-                style_function=lambda feat: {
-                    "color": "#00b894",
-                    "weight": 2,
-                    "fillColor": "#00b894",
-                    "fillOpacity": 0.05,
-                },
-                tooltip=GeoJsonTooltip(
-                    fields=["NM_BAIRRO"],
-                    aliases=["Bairro:"],
-                    sticky=False
+        if modo_mapa == MODOS_MAPA[2] and lat_col and lon_col:
+            # Mapa fixo por versão dos dados; o filtro vai como máscara de visitas
+            # e o calor como a mesma grade agregada dos outros modos
+            fmap, mapa_df, extras = mapa_cliente(dataset, data_version, mostrar_historico)
+            pontos = (
+                pontos_calor(dataset["calor"], view["calor"], agregacao_calor)
+                if view["calor"] is not None
+                else []
+            )
+            fg_filtro = camada_filtro_cliente(view["rows"], len(df), pontos)
+            map_data = st_folium(
+                fmap, height=500, use_container_width=True, feature_group_to_add=fg_filtro,
+                key="mapa",
+            )
+        elif modo_mapa == MODOS_MAPA[3] and lat_col and lon_col:
+            # Mapa fixo por versão dos dados; a cada movimento vai só a área visível
+            fmap = mapa_area_visivel(dataset)
+            mapa_df = df.iloc[view["mapa"]["latest"]]
+            vazao_todas = (
+                df["Vazão_LH"].to_numpy(dtype="float64", na_value=np.nan)
+                if mostrar_historico and "Vazão_LH" in df.columns
+                else None
+            )
+            extras = extras_popup(view["mapa"], vazao_todas)
+
+            # Antes do primeiro retorno do mapa, a área é a de todos os poços
+            caixa = caixa_mapa
+            if caixa is None:
+                cad = dataset["spatial"]
+                caixa = (
+                    float(np.nanmin(cad.lat)), float(np.nanmin(cad.lon)),
+                    float(np.nanmax(cad.lat)), float(np.nanmax(cad.lon)),
                 )
-            ).add_to(fmap)
-        except Exception as e:
-            st.warning(f"⚠️ Camada de bairros não disponível: {e}")
+            zoom = int(zoom_mapa) if isinstance(zoom_mapa, (int, float)) else zoom_para_caixa(caixa)
 
-        fg_pocos = folium.FeatureGroup(name="Poços (Status)", show=True)
-        pts = []
-
-        status_colors = {
-            "Instalado": "#00b894",
-            "Não instalado": "#e17055",
-            "Desativado": "#636e72",
-            "Obstruído": "#d63031",
-            "Injetado": "#6c5ce7",
-        }
-        default_color = "#0984e3"
+            fg_area, resumo = camada_area_visivel(dataset, mapa_df, extras, caixa, zoom)
+            map_data = st_folium(
+                fmap, height=500, use_container_width=True, feature_group_to_add=fg_area,
+                key="mapa",
+            )
+            st.caption(
+                f"Zoom {zoom}: {resumo['agrupamentos']} agrupamentos e "
+                f"{resumo['pocos']} poços individuais na área visível."
+            )
+        else:
+            fmap = mapa_base()
+
+            # Um marcador por poço: a visita mais recente dentro dos filtros
+            mapa = view["mapa"]
+            mapa_df = df.iloc[mapa["latest"]]
+            vazao_todas = (
+                df["Vazão_LH"].to_numpy(dtype="float64", na_value=np.nan)
+                if mostrar_historico and "Vazão_LH" in df.columns
+                else None
+            )
+            extras = extras_popup(mapa, vazao_todas)
 
-        lat_col = "latitude" if "latitude" in fdf.columns else None
-        lon_col = "longitude" if "longitude" in fdf.columns else None
+            if lat_col and lon_col:
+                camada_pocos(modo_mapa, mapa_df, extras).add_to(fmap)
 
-        if lat_col and lon_col:
-            for _, row in fdf.iterrows():
-                lat = to_float(row.get(lat_col))
-                lon = to_float(row.get(lon_col))
-                if lat is None or lon is None:
-                    continue
+            # Heatmap: grade agregada da visão (uma célula por ponto, não uma visita)
+            if view["calor"] is not None:
+                pontos = pontos_calor(dataset["calor"], view["calor"], agregacao_calor)
+                if pontos:
+                    camada_calor(pontos).add_to(fmap)
 
-                status = row.get("Status", "")
-                color = status_colors.get(str(status), default_color)
-
-                popup_html = make_popup_html(row)
-                popup = folium.Popup(popup_html, max_width=360)
-
-                tooltip_text = str(row.get("Localidade", "Poço"))
-                if status:
-                    tooltip_text += f" • {status}"
-
-                folium.CircleMarker(
-                    location=[lat, lon],
-                    radius=10,
-                    color=color,
-                    fill=True,
-                    fill_color=color,
-                    fill_opacity=0.9,
-                    popup=popup,
-                    tooltip=tooltip_text,
-                    weight=2
-                ).add_to(fg_pocos)
-
-                pts.append((lat, lon))
-
-        fg_pocos.add_to(fmap)
-
-        # Heatmap
-        if "Vazão_LH" in fdf.columns and lat_col and lon_col:
-            heat_df = fdf[[lat_col, lon_col, "Vazão_LH"]].copy()
-            heat_df["lat"] = heat_df[lat_col].apply(to_float)
-            heat_df["lon"] = heat_df[lon_col].apply(to_float)
-            heat_df["val"] = pd.to_numeric(heat_df["Vazão_LH"], errors="coerce")
-
-            heat_df = heat_df.dropna(subset=["lat", "lon", "val"])
-
-            if not heat_df.empty:
-                heat_points = heat_df[["lat", "lon", "val"]].values.tolist()
-                fg_heat = folium.FeatureGroup(name="Mapa de Calor - Vazão", show=False)
-                HeatMap(
-                    heat_points,
-                    radius=25,
-                    blur=20,
-                    max_zoom=12,
-                    gradient={0.4: 'blue', 0.65: 'lime', 1: 'red'}
-                ).add_to(fg_heat)
-                fg_heat.add_to(fmap)
-
-        if pts:
-            fmap.fit_bounds([
-                [min(p[0] for p in pts), min(p[1] for p in pts)],
-                [max(p[0] for p in pts), max(p[1] for p in pts)],
-            ])
-
-        # Legenda com opção de recolher
-        legend_html = """
-        {% macro html(this, kwargs) %}
-        <div id="legend-pocos" style="
-            position: fixed;
-            bottom: 40px;
-            left: 10px;
-            z-index: 9999;
-            background: rgba(255,255,255,0.95);
-            padding: 12px 16px;
-            border: 1px solid #ddd;
-            border-radius: 16px;
-            font-size: 12px;
-            box-shadow: 0 4px 20px rgba(0,0,0,0.15);
-            backdrop-filter: blur(10px);
-            font-family: 'Segoe UI', system-ui, sans-serif;
-        ">
-          <div id="legend-pocos-header" style="font-weight:700; margin-bottom:6px; color:#2d3436; font-size:13px; cursor:pointer;"
-               onclick="
-                 var body = document.getElementById('legend-pocos-body');
-                 if (body.style.display === 'none') {
-                     body.style.display = 'block';
-                     this.innerHTML = 'Status dos Poços ▾';
-                 } else {
-                     body.style.display = 'none';
-                     this.innerHTML = 'Status dos Poços ▸';
-                 }
-               ">
-            Status dos Poços ▾
-          </div>
-          <div id="legend-pocos-body" style="margin-top:4px;">
-            <div style="display:flex;align-items:center;margin-bottom:4px;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#00b894;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Instalado
-            </div>
-            <div style="display:flex;align-items:center;margin-bottom:4px;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#e17055;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Não instalado
-            </div>
-            <div style="display:flex;align-items:center;margin-bottom:4px;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#636e72;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Desativado
-            </div>
-            <div style="display:flex;align-items:center;margin-bottom:4px;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#d63031;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Obstruído
-            </div>
-            <div style="display:flex;align-items:center;margin-bottom:4px;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#6c5ce7;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Injetado
-            </div>
-            <div style="display:flex;align-items:center;">
-              <span style="display:inline-block;width:14px;height:14px;border-radius:50%;background:#0984e3;margin-right:6px;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);"></span>Outros
-            </div>
-          </div>
-        </div>
-        {% endmacro %}
-        """
-        legend = MacroElement()
-        legend._template = Template(legend_html)
-        fmap.get_root().add_child(legend)
+            if lat_col and lon_col:
+                ajusta_limites(fmap, mapa_df)
 
-        # ⬇️ Botão de camadas recolhido (apenas ícone)
-        LayerControl(collapsed=True).add_to(fmap)
+            finaliza_mapa(fmap)
+            map_data = st_folium(fmap, height=500, use_container_width=True, key="mapa")
 
-        map_data = st_folium(fmap, height=500, use_container_width=True)
+# Último clique no mapa (num poço ou numa área vazia)
+clique = None
+if map_data and lat_col and lon_col:
+    clique = map_data.get("last_object_clicked") or map_data.get("last_clicked")
 
 with col_fotos:
     st.markdown("#### 📸 Galeria de Fotos")
@@ -1125,25 +3127,24 @@ with col_fotos:
     with st.container():
         foto_col = "Link da Foto" if "Link da Foto" in fdf.columns else None
 
-        fdf_gallery = fdf.copy()
+        fdf_gallery = fdf
         clicked = False
 
-        if map_data and 'last_object_clicked' in map_data and lat_col and lon_col:
-            click_info = map_data.get("last_object_clicked") or map_data.get("last_clicked")
-            if click_info:
-                clicked = True
-                click_lat = click_info["lat"]
-                click_lon = click_info["lng"]
+        if clique:
+            click_lat = clique["lat"]
+            click_lon = clique["lng"]
 
-                tmp = fdf.copy()
-                tmp["_lat"] = tmp[lat_col].apply(to_float)
-                tmp["_lon"] = tmp[lon_col].apply(to_float)
-                tmp = tmp.dropna(subset=["_lat", "_lon"])
+            # Poço mais próximo entre os visíveis, pelo índice espacial
+            wid, dist_m = dataset["spatial"].nearest(
+                click_lat, click_lon, CLICK_SNAP_M, permitido=pocos_visiveis
+            )
 
-                if not tmp.empty:
-                    tmp["dist2"] = (tmp["_lat"] - click_lat) ** 2 + (tmp["_lon"] - click_lon) ** 2
-                    tmp = tmp.sort_values("dist2")
-                    fdf_gallery = tmp.head(1)
+            if wid is not None:
+                # Todas as visitas filtradas do poço escolhido
+                clicked = True
+                fdf_gallery = fdf[fdf["well_id"].to_numpy() == wid]
+            else:
+                st.caption(f"Nenhum poço a menos de {CLICK_SNAP_M:.0f} m do clique.")
 
         if not foto_col:
             st.info("📷 Coluna de fotos não encontrada na planilha.")
@@ -1161,7 +3162,10 @@ with col_fotos:
 
                 loc = row.get("Localidade", "")
                 bairro = row.get("Bairro", "")
-                caption_parts = [str(loc) if loc else None, str(bairro) if bairro else None]
+                caption_parts = [
+                    str(loc) if pd.notna(loc) and loc else None,
+                    str(bairro) if pd.notna(bairro) and bairro else None,
+                ]
                 caption = " • ".join([p for p in caption_parts if p])
 
                 fid = gdrive_extract_id(link)
@@ -1183,6 +3187,60 @@ with col_fotos:
 
             render_lightgallery_images(items, height_px=410, auto_open=auto_open)
 
+# =============================
+# Poços próximos ao ponto clicado
+# =============================
+if clique and dataset["spatial"] is not None:
+    st.markdown("#### 📍 Poços próximos ao ponto clicado")
+    raio_km = st.number_input(
+        "Raio (km)", min_value=0.1, max_value=100.0, value=5.0, step=0.5, key="raio_proximos"
+    )
+    raio_txt = f"{raio_km:g}".replace(".", ",")
+    ids_prox, dist_prox = dataset["spatial"].within_radius(
+        clique["lat"], clique["lng"], raio_km * 1000, permitido=pocos_visiveis
+    )
+    if not len(ids_prox):
+        st.info(f"Nenhum poço filtrado a até {raio_txt} km do ponto clicado.")
+    else:
+        # Linha da visita mais recente (dentro dos filtros) de cada poço
+        latest = view["mapa"]["latest"]
+        pos = np.full(len(pocos_visiveis), -1, dtype=np.intp)
+        pos[df["well_id"].to_numpy()[latest]] = np.arange(len(latest))
+        cols_prox = [
+            c for c in ["Localidade", "Bairro", "Município", "Status", "Vazão_LH"]
+            if c in df.columns
+        ]
+        proximos = df.iloc[latest[pos[ids_prox]]][cols_prox].copy()
+        proximos.insert(0, "Distância (km)", np.round(dist_prox / 1000, 2))
+        st.caption(
+            f"{len(ids_prox)} poços filtrados a até {raio_txt} km de "
+            f"({clique['lat']:.5f}, {clique['lng']:.5f})"
+        )
+        st.dataframe(proximos, hide_index=True, use_container_width=True, height=250)
+
+# =============================
+# Evolução mensal do mapa de calor
+# =============================
+if dataset["quadros"] is not None and dataset["quadros"].rotulos:
+    if st.toggle("🎞️ Evolução mensal do mapa de calor", value=False, key="tg_quadros"):
+        metrica_quadros = st.selectbox("Peso dos quadros", METRICAS_QUADROS, key="metrica_quadros")
+        # Quadros da visão filtrada, no mesmo cache das visões
+        agregado_quadros = view_cache.get_or_compute(
+            (data_version, filter_key(selecao_final), "quadros", metrica_quadros),
+            lambda: dataset["quadros"].agrega(view["rows"], metrica_quadros),
+        )
+        fmap_tempo = mapa_base()
+        camada_tempo, dados_tempo = camada_quadros(dataset["quadros"], agregado_quadros)
+        camada_tempo.add_to(fmap_tempo)
+        ajusta_limites(fmap_tempo, dataset["wells"].wells)
+        st_folium(
+            fmap_tempo, height=450, use_container_width=True, key="mapa_tempo", returned_objects=[],
+        )
+        st.caption(
+            f"{len(dados_tempo)} meses • {len(agregado_quadros['peso'])} pares mês × célula "
+            f"({len(json.dumps(dados_tempo)) / 1024:.1f} KB)"
+        )
+
 # =============================
 # Gráficos Modernizados
 # =============================
@@ -1204,29 +3262,7 @@ def barra_contagem_moderna(colname, titulo, col_container):
 
     # Caso especial: Status x Ano_visita (contando poços únicos por ano)
     if colname == "Status" and "Ano_visita" in fdf.columns:
-        # Monta colunas necessárias
-        cols = ["Ano_visita", colname]
-        if "Latitude_2" in fdf.columns:
-            cols.append("Latitude_2")
-
-        tmp = fdf[cols].dropna(subset=["Ano_visita", colname]).copy()
-
-        # Se existir Latitude_2, garante que cada poço conte no máximo 1 vez por ano
-        if "Latitude_2" in tmp.columns:
-            non_null = (
-                tmp[tmp["Latitude_2"].notna()]
-                .drop_duplicates(subset=["Ano_visita", "Latitude_2"])
-                .copy()
-            )
-            null_part = tmp[tmp["Latitude_2"].isna()].copy()
-            tmp = pd.concat([non_null, null_part], ignore_index=True)
-
-        # Agora sim, agrupa por ano e status
-        tmp_grouped = (
-            tmp.groupby(["Ano_visita", colname])
-            .size()
-            .reset_index(name="contagem")
-        )
+        tmp_grouped = view["charts"]["status_ano"]
 
         if tmp_grouped.empty:
             with col_container:
@@ -1284,13 +3320,7 @@ def barra_contagem_moderna(colname, titulo, col_container):
 
     else:
         # Demais gráficos: contagem simples
-        tmp = (
-            fdf[[colname]]
-            .dropna()
-            .groupby(colname)
-            .size()
-            .reset_index(name="contagem")
-        )
+        tmp = view["charts"][colname]
         if tmp.empty:
             with col_container:
                 st.info(f"📊 Sem dados de {titulo} para os filtros atuais")
@@ -1329,31 +3359,13 @@ def grafico_caixas_por_ano(col_container):
             st.info("📋 Dados de Caixas de apoio por ano não disponíveis")
         return
 
-    tmp = (
-        fdf[["Ano_visita", "Caixas_apoio"]]
-        .dropna(subset=["Ano_visita", "Caixas_apoio"])
-        .copy()
-    )
+    agg = view["charts"]["caixas_ano"]
 
-    if tmp.empty:
+    if agg.empty:
         with col_container:
             st.info("📊 Sem dados de Caixas de apoio para os filtros atuais")
         return
 
-    tmp["Caixas_apoio"] = pd.to_numeric(tmp["Caixas_apoio"], errors="coerce")
-    tmp = tmp.dropna(subset=["Caixas_apoio"])
-
-    if tmp.empty:
-        with col_container:
-            st.info("📊 Sem dados numéricos de Caixas de apoio para os filtros atuais")
-        return
-
-    agg = (
-        tmp.groupby("Ano_visita")["Caixas_apoio"]
-        .sum()
-        .reset_index(name="total_caixas")
-    )
-
     chart = (
         alt.Chart(agg)
         .mark_bar(cornerRadius=6)
@@ -1402,11 +3414,7 @@ cols_tabela = [
 
 cols_existentes = [c for c in cols_tabela if c in fdf.columns]
 
-tabela = fdf[cols_existentes].copy()
-
-for col in ["Vazão_LH", "Vazão_estimada_LH", "Cloretos"]:
-    if col in tabela.columns:
-        tabela[col] = pd.to_numeric(tabela[col], errors="coerce")
+tabela = fdf_area[cols_existentes]
 
 def style_dataframe(df: pd.DataFrame):
     fmt = {}
@@ -1431,6 +3439,76 @@ st.dataframe(
     height=450
 )
 
+# =============================
+# Diagnóstico
+# =============================
+def fmt_ts(ts):
+    return ts.astimezone(TZ).strftime("%d/%m/%Y %H:%M:%S") if ts else "-"
+
+with st.expander("🛠️ Diagnóstico dos dados", expanded=False):
+    mon = sheet_cache.monitor
+    d1, d2, d3 = st.columns(3)
+    d1.metric("Último sucesso", fmt_ts(mon["last_success"]))
+    d2.metric("Última falha", fmt_ts(mon["last_failure"]))
+    d3.metric(
+        "Duração da última busca",
+        f"{mon['last_duration_s']:.2f} s" if mon["last_duration_s"] is not None else "-",
+    )
+    if mon["last_error"]:
+        st.caption(f"Último erro: {mon['last_error']}")
+    if mon["snapshot_error"]:
+        st.caption(f"Falha ao gravar snapshot: {mon['snapshot_error']}")
+    if dataset["date_formats"]:
+        st.caption(
+            "Formatos de data reconhecidos: "
+            + ", ".join(f"{fmt} ({n})" for fmt, n in dataset["date_formats"].items())
+        )
+    reg = dataset["wells"]
+    st.caption(
+        f"Poços identificados: {reg.n_wells} • {reg.n_latitude_2 - reg.n_wells} "
+        f"unidos por proximidade (até {reg.tolerance_m:g} m)"
+    )
+    divergentes = dataset.get("bairros_divergentes")
+    if divergentes is not None:
+        no_mapa = int(reg.wells["Bairro_geo"].notna().sum())
+        st.caption(
+            f"Bairro pelo mapa: {no_mapa} de {reg.n_wells} poços dentro de um polígono • "
+            f"{int(divergentes['Poços'].sum())} com Bairro diferente na planilha"
+        )
+        if not divergentes.empty:
+            st.dataframe(divergentes, hide_index=True, height=180)
+    for col, valores in dataset["unmapped"].items():
+        if valores:
+            st.caption(f"Valores não padronizados em {col}: {', '.join(valores)}")
+    sc = sheet_cache.stats
+    st.caption(
+        f"Versão dos dados: {data_version or '-'} • "
+        f"Cache da planilha: {sc['hits']} acertos • {sc['misses']} downloads • "
+        f"{sc['revalidated']} revalidações • {sc['stale']} servidas vencidas • "
+        f"{sc['coalesced']} requisições compartilhadas • {sc['throttled']} limitadas"
+    )
+    vc = view_cache.stats
+    st.caption(
+        f"Cache de visões: {vc['hits']} acertos • {vc['misses']} faltas • "
+        f"{vc['evictions']} descartes • {len(view_cache)} visões • "
+        f"{view_cache.nbytes / 1e6:.1f} de {view_cache.budget_bytes / 1e6:.0f} MB"
+    )
+    try:
+        cb = camada_bairros()
+        st.caption(
+            f"Camada de bairros (zoom {cb['zoom']}): {cb['bytes_antes'] / 1024:.1f} KB → "
+            f"{cb['bytes_depois'] / 1024:.1f} KB • {cb['vertices_antes']} → "
+            f"{cb['vertices_depois']} vértices"
+        )
+    except OSError:
+        pass
+    if view["calor"] is not None:
+        grade = dataset["calor"]
+        st.caption(
+            f"Mapa de calor: {len(view['calor']['celulas'])} células de uma grade "
+            f"{grade.nx}×{grade.ny} para {int(view['calor']['n'].sum())} visitas com vazão"
+        )
+
 # =============================
 # Footer Modernizado
 # =============================
@@ -0,0 +1,34 @@
+"""Carrega as definições de app.py sem executar a página.
+
+app.py é um script Streamlit: tudo até a seção "Header Modernizado" são
+importações, configuração e definições; dali em diante vem a página, com
+funções e constantes intercaladas. Executamos a primeira parte inteira e,
+da segunda, só as definições (funções, classes e constantes em maiúsculas).
+"""
+import ast
+from pathlib import Path
+from types import SimpleNamespace
+
+APP_PATH = Path(__file__).resolve().parents[1] / "app.py"
+MARCA_PAGINA = "# =============================\n# Header Modernizado"
+
+
+def carrega_app() -> SimpleNamespace:
+    fonte = APP_PATH.read_text(encoding="utf-8")
+    corte = fonte.index(MARCA_PAGINA)
+    ns = {"__file__": str(APP_PATH), "__name__": "app"}
+    exec(compile(fonte[:corte], str(APP_PATH), "exec"), ns)
+
+    pagina = ast.parse(fonte[corte:])
+    definicoes = [
+        no for no in pagina.body
+        if isinstance(no, (ast.FunctionDef, ast.ClassDef))
+        or (
+            isinstance(no, ast.Assign)
+            and all(isinstance(alvo, ast.Name) and alvo.id.isupper() for alvo in no.targets)
+        )
+    ]
+    # Mantém a numeração de linhas de app.py nos tracebacks
+    ast.increment_lineno(pagina, fonte[:corte].count("\n"))
+    exec(compile(ast.Module(definicoes, []), str(APP_PATH), "exec"), ns)
+    return SimpleNamespace(**ns)
@@ -0,0 +1,87 @@
+"""Comparação dos modos de renderização do mapa, fora do app.
+
+Uso:
+    python tests/bench_mapa.py planilha.csv
+
+Carrega a planilha como o app (parse_sheet_csv + prepare_dataset), usa os
+poços da visão sem filtros e mede o tamanho do HTML e o tempo para montar e
+renderizar o mapa em cada modo, e o custo de gerar os popups de 10 mil poços
+em cada forma.
+"""
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from app_defs import carrega_app
+
+
+def benchmark_camadas(app, mapa_df: pd.DataFrame, extras: list) -> pd.DataFrame:
+    """Tamanho do HTML e tempo para montar + renderizar o mapa em cada modo."""
+    linhas = []
+    for modo in app.MODOS_MAPA[:2]:
+        t0 = time.perf_counter()
+        m = app.folium.Map(location=[-5.45, -39.7], zoom_start=11)
+        app.camada_pocos(modo, mapa_df, extras).add_to(m)
+        html = m.get_root().render()
+        linhas.append({
+            "Modo": modo,
+            "Poços": len(mapa_df),
+            "HTML (KB)": round(len(html.encode("utf-8")) / 1024, 1),
+            "Tempo (ms)": round((time.perf_counter() - t0) * 1000, 1),
+        })
+    return pd.DataFrame(linhas)
+
+
+def benchmark_popups(app, mapa_df: pd.DataFrame, extras: list, n: int = 10_000) -> pd.DataFrame:
+    """Tempo e tamanho dos popups de n poços (os poços atuais repetidos até n)."""
+    idx = np.resize(np.arange(len(mapa_df)), n)
+    amostra = mapa_df.iloc[idx]
+    extras_n = [extras[k] for k in idx.tolist()]
+    linhas = []
+
+    def mede(nome, gera, tamanho):
+        t0 = time.perf_counter()
+        saida = gera()
+        ms = (time.perf_counter() - t0) * 1000
+        linhas.append({
+            "Popups": nome,
+            "Poços": n,
+            "Tamanho (KB)": round(tamanho(saida) / 1024, 1),
+            "Tempo (ms)": round(ms, 1),
+        })
+
+    def tamanho_html(html):
+        return sum(len(h.encode("utf-8")) for h in html)
+
+    mede(
+        "HTML por linha (make_popup_html)",
+        lambda: [app.make_popup_html(row, extras_n[k]) for k, (_, row) in enumerate(amostra.iterrows())],
+        tamanho_html,
+    )
+    mede("HTML pelo modelo compilado", lambda: app.popups_html(amostra, extras_n), tamanho_html)
+    mede(
+        "Só propriedades (GeoJSON, popup ao abrir)",
+        lambda: app.geojson_pocos(amostra, extras_n),
+        lambda dados: len(json.dumps(dados, ensure_ascii=False).encode("utf-8")),
+    )
+    return pd.DataFrame(linhas)
+
+
+def main(caminho: str):
+    app = carrega_app()
+    with open(caminho, "rb") as f:
+        dataset = app.prepare_dataset(app.parse_sheet_csv(f.read()))
+    mapa = app.compute_view(dataset, {})["mapa"]
+    mapa_df = dataset["df"].iloc[mapa["latest"]]
+    extras = app.extras_popup(mapa)
+
+    with pd.option_context("display.width", 120):
+        print(benchmark_camadas(app, mapa_df, extras).to_string(index=False))
+        print()
+        print(benchmark_popups(app, mapa_df, extras).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
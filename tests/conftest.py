@@ -0,0 +1,13 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from app_defs import carrega_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    return carrega_app()
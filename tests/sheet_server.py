@@ -0,0 +1,70 @@
+"""Servidor HTTP local que faz o papel do export CSV do Google Sheets.
+
+Serve um único CSV em qualquer caminho. Com etag=True responde ETag e 304
+para If-None-Match igual (revalidação condicional); com etag=False não manda
+validadores, e o SheetCache cai na comparação pelo hash do corpo.
+
+Uso avulso (para rodar o app offline):
+    python tests/sheet_server.py planilha.csv [porta] [--sem-etag]
+    SHEET_CSV_URL=http://127.0.0.1:<porta>/sheet.csv streamlit run app.py
+"""
+import hashlib
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SheetServer:
+    def __init__(self, corpo: bytes, etag: bool = True, porta: int = 0):
+        self.corpo = corpo
+        self.etag = etag
+        self.requisicoes = []  # (If-None-Match recebido, status devolvido)
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                corpo = servidor.corpo
+                tag = f'"{hashlib.sha256(corpo).hexdigest()[:16]}"'
+                recebido = self.headers.get("If-None-Match")
+                if servidor.etag and recebido == tag:
+                    servidor.requisicoes.append((recebido, 304))
+                    self.send_response(304)
+                    self.send_header("ETag", tag)
+                    self.end_headers()
+                    return
+                servidor.requisicoes.append((recebido, 200))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv; charset=utf-8")
+                self.send_header("Content-Length", str(len(corpo)))
+                if servidor.etag:
+                    self.send_header("ETag", tag)
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", porta), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/sheet.csv"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    with open(args[0], "rb") as f:
+        corpo = f.read()
+    porta = int(args[1]) if len(args) > 1 else 8765
+    with SheetServer(corpo, etag="--sem-etag" not in sys.argv, porta=porta) as srv:
+        print(f"Servindo {args[0]} em {srv.url} (Ctrl+C para sair)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
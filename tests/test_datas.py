@@ -0,0 +1,18 @@
+import pandas as pd
+
+
+def test_ano_primeiro_nao_troca_dia_e_mes(app):
+    textos = pd.Series([
+        "2024-02-03 10:00", "2024/02/03", "2024-02-03T10:00:00",
+        "2024.02.03", "2024-2-3",
+    ])
+    datas, _ = app.parse_visit_dates(textos)
+    assert (datas.dt.month == 2).all() and (datas.dt.day == 3).all()
+
+
+def test_dia_primeiro_no_resto(app):
+    textos = pd.Series(["03/02/2024", "03-02-2024 10:00", "3.2.2024", "03/02/24", None, "xx"])
+    datas, formatos = app.parse_visit_dates(textos)
+    assert (datas[:4].dt.month == 2).all() and (datas[:4].dt.day == 3).all()
+    assert datas[4:].isna().all()
+    assert formatos["%d/%m/%Y"] == 1
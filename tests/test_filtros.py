@@ -0,0 +1,82 @@
+"""Filtros facetados numa sessão aberta, com o app rodando contra o servidor local."""
+import re
+
+import pytest
+from sheet_server import SheetServer
+from streamlit.testing.v1 import AppTest
+
+from app_defs import APP_PATH
+
+CABECALHO = "Ano,Município,Localidade,Bairro,Status,Vazão_estimada_LH,Caixas_apoio,Data_visita,latitude,longitude\n"
+# Coordenadas fora dos polígonos dos bairros: vale o Bairro da planilha
+LINHAS_V1 = (
+    "2024,Pedra Branca,Loc 1,Centro,Ativo,1000,1,01/07/2024,-7.4501,-38.7001\n"
+    "2024,Pedra Branca,Loc 2,Alto,Ativo,2000,2,02/07/2024,-7.4601,-38.7101\n"
+    "2023,Pedra Branca,Loc 3,Várzea,Seco,3000,3,03/07/2023,-7.4701,-38.7201\n"
+    "2023,Mombaça,Loc 4,Centro,Ativo,4000,4,04/07/2023,-7.3701,-38.6201\n"
+)
+LINHAS_NOVAS = "2024,Quixadá,Loc 5,Centro,Injetado,5000,5,05/07/2024,-7.9701,-38.0201\n"
+
+
+def kpis(at):
+    return [
+        re.sub(r"\s+", " ", re.sub("<[^>]+>", " ", m.value)).strip()
+        for m in at.markdown
+        if "kpi-value" in m.value and "<style>" not in m.value
+    ]
+
+
+def opcoes(at, key):
+    return [re.sub(r" \(\d+\)$", "", o) for o in at.multiselect(key=key).options]
+
+
+@pytest.fixture
+def servidor(monkeypatch, tmp_path):
+    with SheetServer((CABECALHO + LINHAS_V1).encode("utf-8")) as srv:
+        monkeypatch.setenv("SHEET_CSV_URL", srv.url)
+        monkeypatch.setenv("SHEET_SNAPSHOT_PATH", str(tmp_path / "snap.feather"))
+        monkeypatch.setenv("SHEET_MIN_REFRESH_S", "0")
+        yield srv
+
+
+def abre_sessao():
+    at = AppTest.from_file(str(APP_PATH), default_timeout=120)
+    at.run()
+    assert not at.exception
+    return at
+
+
+def atualiza(at, srv, linhas):
+    srv.corpo = (CABECALHO + linhas).encode("utf-8")
+    next(b for b in at.button if "Atualizar" in b.label).click().run()
+    assert not at.exception
+
+
+def test_cascata_estreita_as_opcoes(servidor):
+    at = abre_sessao()
+    assert opcoes(at, "f_bairro") == ["Alto", "Centro", "Várzea"]
+
+    at.multiselect(key="f_mun").set_value(["Mombaça"]).run()
+    assert opcoes(at, "f_bairro") == ["Centro"]
+    assert at.multiselect(key="f_bairro").value == ["Centro"]
+
+
+def test_dados_novos_entram_na_sessao_aberta(servidor):
+    at = abre_sessao()
+    atualiza(at, servidor, LINHAS_V1 + LINHAS_NOVAS)
+
+    assert "Quixadá" in at.multiselect(key="f_mun").value
+    assert "Injetado" in at.multiselect(key="f_status").value
+    assert kpis(at) == kpis(abre_sessao())
+
+
+def test_escolha_do_usuario_sobrevive_e_perde_valores_que_sumiram(servidor):
+    at = abre_sessao()
+    at.multiselect(key="f_status").set_value(["Ativo", "Seco"]).run()
+    at.multiselect(key="f_status").set_value(["Seco"]).run()
+    assert at.multiselect(key="f_status").value == ["Seco"]
+
+    # Seco some da planilha: a escolha fica vazia (filtro desligado), sem erro
+    atualiza(at, servidor, LINHAS_V1.replace("Seco", "Ativo") + LINHAS_NOVAS)
+    assert at.multiselect(key="f_status").value == []
+    assert "Injetado" in opcoes(at, "f_status")
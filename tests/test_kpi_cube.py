@@ -0,0 +1,80 @@
+"""KpiCube contra calcula_kpis em seleções aleatórias.
+
+A contagem de poços tem que bater exatamente. As somas em ponto flutuante
+(vazões e caixas) são as mesmas parcelas somadas em outra ordem: o cubo soma
+por célula e depois as células, calcula_kpis soma as linhas em sequência.
+Para n parcelas, a diferença entre duas ordens de soma fica abaixo de
+2·(n-1)·eps·Σ|x| (limite clássico da soma recursiva), que é a tolerância
+usada aqui.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+EPS = np.finfo(np.float64).eps
+N_SELECOES = 200
+
+
+@pytest.fixture(scope="module")
+def dataset(app):
+    rng = np.random.default_rng(12)
+    n_pocos, n = 120, 3000
+    lat = rng.uniform(-5.60, -5.35, n_pocos)
+    lon = rng.uniform(-39.80, -39.55, n_pocos)
+    poco = rng.integers(0, n_pocos, n)
+    dia = rng.integers(1, 29, n)
+    mes = rng.integers(1, 13, n)
+    ano = rng.choice([2021, 2022, 2023, 2024], n)
+
+    def com_faltas(valores, frac=0.15):
+        return np.where(rng.random(n) < frac, None, valores)
+
+    planilha = pd.DataFrame({
+        "Ano": ano,
+        "Município": rng.choice(["Pedra Branca", "Mombaça", "Senador Pompeu"], n),
+        "Localidade": com_faltas(np.array([f"Loc {p}" for p in poco]), 0.05),
+        "Bairro": com_faltas(rng.choice(["Centro", "Alto", "Várzea"], n)),
+        "Vazão_LH": com_faltas(np.round(rng.gamma(2, 1500, n), 2)),
+        "Vazão_estimada_LH": com_faltas(np.round(rng.gamma(2, 2500, n), 2)),
+        "Monitorado": rng.choice(["Sim", "nao", "NÃO"], n),
+        "Instalado": rng.choice(["Sim", "Não"], n),
+        "Status": rng.choice(["Ativo", "obstruido", "Seco"], n),
+        "Caixas_apoio": com_faltas(rng.integers(0, 4, n)),
+        "Data_visita": [f"{d:02d}/{m:02d}/{a}" for d, m, a in zip(dia, mes, ano)],
+        "latitude": lat[poco],
+        "longitude": lon[poco],
+    })
+    bruto = app.parse_sheet_csv(planilha.to_csv(index=False).encode("utf-8"))
+    return app.prepare_dataset(bruto)
+
+
+def tolerancia(parcelas):
+    x = np.nan_to_num(pd.to_numeric(parcelas, errors="coerce").to_numpy(dtype="float64", na_value=np.nan))
+    return 2 * max(len(x) - 1, 1) * EPS * np.abs(x).sum()
+
+
+def test_cubo_igual_ao_calculo_por_linha(app, dataset):
+    df, fidx, cubo = dataset["df"], dataset["filters"], dataset["kpis"]
+    assert len(cubo.cells) > 1
+
+    rng = np.random.default_rng(7)
+    for i in range(N_SELECOES):
+        selecao = {}
+        if i:
+            for dim, valores in fidx.values.items():
+                if valores and rng.random() < 0.5:
+                    k = int(rng.integers(1, len(valores) + 1))
+                    selecao[dim] = list(rng.choice(np.array(valores, dtype=object), k, replace=False))
+
+        base = df.iloc[fidx.rows(selecao)]
+        ref = app.calcula_kpis(base)
+        got = cubo.kpis(selecao)
+
+        assert got["total_pocos"] == ref["total_pocos"], selecao
+        um_por_poco = base.iloc[app.primeira_por_chave(base["well_id"].to_numpy())]
+        for chave, parcelas in (
+            ("total_vazao", um_por_poco["Vazão_LH"]),
+            ("total_vazao_est", base["Vazão_estimada_LH"]),
+            ("total_caixas", base["Caixas_apoio"]),
+        ):
+            assert abs(got[chave] - ref[chave]) <= tolerancia(parcelas), (chave, selecao)
@@ -0,0 +1,8 @@
+def test_inteiro_fora_da_faixa_vira_nulo(app):
+    bruto = app.parse_sheet_csv(
+        "Ano,Caixas_apoio\n2024,1\n2023,40000\n20242025,-40000\n2022,2.5\n".encode("utf-8")
+    )
+    assert str(bruto["Ano"].dtype) == "Int16"
+    assert bruto["Ano"].isna().tolist() == [False, False, True, False]
+    assert bruto["Ano"].dropna().tolist() == [2024, 2023, 2022]
+    assert bruto["Caixas_apoio"].isna().tolist() == [False, True, True, True]
@@ -0,0 +1,51 @@
+"""Agrupamento de poços por proximidade contra a comparação visita a visita."""
+import numpy as np
+import pytest
+
+
+def pares_forca_bruta(x, y, tol, grupo):
+    d = np.hypot(x[:, None] - x[None], y[:, None] - y[None]) <= tol
+    i, j = np.nonzero(np.triu(d & (grupo[:, None] != grupo[None]), 1))
+    return set(zip(i.tolist(), j.tolist()))
+
+
+@pytest.mark.parametrize("max_pares", [1, 7, 1_000_000])
+def test_pares_proximos(app, max_pares):
+    rng = np.random.default_rng(max_pares)
+    for _ in range(20):
+        n = int(rng.integers(2, 300))
+        x, y = rng.uniform(0, 40, n), rng.uniform(0, 40, n)
+        grupo = rng.integers(0, max(1, n // 4), n)
+        a, b = app.pares_proximos(x, y, 5.0, grupo=grupo, max_pares=max_pares)
+        assert set(zip(a.tolist(), b.tolist())) == pares_forca_bruta(x, y, 5.0, grupo)
+
+        a, b = app.pares_proximos(x, y, 5.0, max_pares=max_pares)
+        assert set(zip(a.tolist(), b.tolist())) == pares_forca_bruta(x, y, 5.0, np.arange(n))
+
+
+def test_agrupa_igual_a_ligacao_visita_a_visita(app):
+    rng = np.random.default_rng(5)
+    m = app.METROS_POR_GRAU
+    for _ in range(15):
+        n_pocos, n = int(rng.integers(5, 60)), int(rng.integers(50, 600))
+        # Centros a poucos metros uns dos outros e visitas com ruído de GPS
+        centro_lat = -5.45 + rng.uniform(0, 60, n_pocos) / m
+        centro_lon = -39.6 + rng.uniform(0, 60, n_pocos) / m
+        well = rng.integers(0, n_pocos, n).astype(np.intp)
+        lat = centro_lat[well] + rng.normal(0, 2, n) / m
+        lon = centro_lon[well] + rng.normal(0, 2, n) / m
+        lat[rng.random(n) < 0.05] = np.nan
+
+        rotulo = app.agrupa_pocos_proximos(well.copy(), lat, lon, 5.0)
+
+        ok = np.isfinite(lat) & np.isfinite(lon)
+        lat0 = np.deg2rad(float(np.mean(lat[ok])))
+        x = lon[ok] * m * np.cos(lat0)
+        y = lat[ok] * m
+        pares = np.array(sorted(pares_forca_bruta(x, y, 5.0, well[ok])), dtype=np.intp).reshape(-1, 2)
+        w = well[ok]
+        esperado = app.componentes(n_pocos, w[pares[:, 0]], w[pares[:, 1]])[well]
+
+        # Mesma partição das visitas (os números dos grupos podem diferir)
+        assert len(set(zip(rotulo.tolist(), esperado.tolist()))) == len(set(rotulo.tolist()))
+        assert len(set(rotulo.tolist())) == len(set(esperado.tolist()))
@@ -0,0 +1,103 @@
+"""SheetCache contra o servidor local (tests/sheet_server.py).
+
+Confere os contadores de `stats` nos três caminhos de rede: download novo
+(misses), revalidação sem corpo novo (revalidated — por 304 ou pelo hash do
+corpo quando o servidor não manda ETag) e entrada ainda no TTL (hits).
+"""
+import pytest
+from sheet_server import SheetServer
+
+CSV_V1 = (
+    "Ano,Município,Vazão_LH,Data_visita,latitude,longitude\n"
+    "2024,Pedra Branca,3252.35,01/07/2024,-5.472909,-39.695457\n"
+    "2022,Mombaça,,01/04/2022,-5.372868,-39.656716\n"
+).encode("utf-8")
+CSV_V2 = CSV_V1 + b"2023,Quixeramobim,1200,15/03/2023,-5.19,-39.29\n"
+
+
+def contadores(cache):
+    return {k: cache.stats[k] for k in ("hits", "misses", "revalidated")}
+
+
+@pytest.mark.parametrize("etag", [True, False], ids=["etag-304", "hash-do-corpo"])
+def test_hits_misses_revalidated(app, etag):
+    with SheetServer(CSV_V1, etag=etag) as srv:
+        cache = app.SheetCache(srv.url, ttl_s=3600, min_refresh_s=0)
+
+        primeira = cache.get()
+        assert contadores(cache) == {"hits": 0, "misses": 1, "revalidated": 0}
+        assert len(primeira["data"]) == 2
+
+        assert cache.get() is primeira
+        assert cache.get() is primeira
+        assert contadores(cache) == {"hits": 2, "misses": 1, "revalidated": 0}
+
+        # Corpo igual: revalida sem trocar a entrada
+        assert cache.refresh(force=True) is primeira
+        assert contadores(cache) == {"hits": 2, "misses": 1, "revalidated": 1}
+        if etag:
+            assert srv.requisicoes[-1] == (primeira["etag"], 304)
+        else:
+            assert [s for _, s in srv.requisicoes] == [200, 200]
+
+        # Corpo novo: outro download completo e nova versão
+        srv.corpo = CSV_V2
+        nova = cache.refresh(force=True)
+        assert nova is not primeira
+        assert nova["version"] != primeira["version"]
+        assert len(nova["data"]) == 3
+        assert contadores(cache) == {"hits": 2, "misses": 2, "revalidated": 1}
+        assert srv.requisicoes[-1][1] == 200
+
+
+def test_refresh_dentro_do_ttl_nao_vai_a_rede(app):
+    with SheetServer(CSV_V1) as srv:
+        cache = app.SheetCache(srv.url, ttl_s=3600, min_refresh_s=0)
+        entrada = cache.refresh()
+        assert cache.refresh() is entrada
+        assert len(srv.requisicoes) == 1
+        assert contadores(cache) == {"hits": 0, "misses": 1, "revalidated": 0}
+
+
+def test_entrada_vencida_revalida_em_segundo_plano(app):
+    with SheetServer(CSV_V1) as srv:
+        cache = app.SheetCache(srv.url, ttl_s=0, min_refresh_s=0)
+        entrada = cache.get()
+        assert cache.get() is entrada
+        assert cache.stats["stale"] == 1
+
+        cache._bg_thread.join(timeout=5)
+        assert contadores(cache) == {"hits": 0, "misses": 1, "revalidated": 1}
+        assert srv.requisicoes[-1][1] == 304
+
+
+def test_min_refresh_segura_downloads_forcados(app):
+    with SheetServer(CSV_V1) as srv:
+        cache = app.SheetCache(srv.url, ttl_s=3600, min_refresh_s=60)
+        cache.get()
+        cache.refresh(force=True)
+        assert cache.stats["throttled"] == 1
+        assert len(srv.requisicoes) == 1
+        assert contadores(cache) == {"hits": 0, "misses": 1, "revalidated": 0}
+
+
+def test_falha_no_snapshot_nao_vira_erro_de_atualizacao(app, tmp_path):
+    if app.feather is None:
+        pytest.skip("pyarrow não instalado: snapshot desativado")
+    caminho = str(tmp_path / "nao_existe" / "snap.feather")
+    with SheetServer(CSV_V1) as srv:
+        cache = app.SheetCache(srv.url, min_refresh_s=0, snapshot_path=caminho)
+        cache.get()
+    assert cache.last_error is None
+    assert cache.monitor["snapshot_error"]
+    assert cache.stats["misses"] == 1
+
+
+def test_liberar_o_recurso_para_o_agendador(app, monkeypatch):
+    monkeypatch.setitem(app.SheetCache.refresh.__globals__, "SNAPSHOT_PATH", None)
+    with SheetServer(CSV_V1) as srv:
+        cache = app.get_sheet_cache(srv.url)
+        assert cache._scheduler.is_alive()
+        app.get_sheet_cache.clear()
+        cache._scheduler.join(timeout=5)
+        assert not cache._scheduler.is_alive()